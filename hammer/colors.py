@@ -1,39 +1,47 @@
-try:
-    from fabric import colors
+from hammer.util import is_fabric1
 
-    def style_args(bold):
-        return dict(bold=bold)
 
-except ImportError:
-    import colors
+def _colors():
+    # Imported on first use, importing fabric is slow
+    if is_fabric1:
+        from fabric import colors
+
+    else:
+        import colors
+
+    return colors
+
+
+def style_args(bold):
+    if is_fabric1:
+        return dict(bold=bold)
 
-    def style_args(bold):
-        return dict(style='bold') if bold else dict()
+    return dict(style='bold') if bold else dict()
 
 
 def red(*args, **kwargs):
     bold = kwargs.pop('bold', False)
     kwargs.update(style_args(bold))
 
-    return colors.red(*args, **kwargs)
+    return _colors().red(*args, **kwargs)
 
 
 def green(*args, **kwargs):
     bold = kwargs.pop('bold', False)
     kwargs.update(style_args(bold))
 
-    return colors.green(*args, **kwargs)
+    return _colors().green(*args, **kwargs)
 
 
 def blue(*args, **kwargs):
     bold = kwargs.pop('bold', False)
     kwargs.update(style_args(bold))
 
-    return colors.blue(*args, **kwargs)
+    return _colors().blue(*args, **kwargs)
 
 
 def yellow(*args, **kwargs):
     bold = kwargs.pop('bold', False)
     kwargs.update(style_args(bold))
 
-    return colors.yellow(*args, **kwargs)
+    return _colors().yellow(*args, **kwargs)
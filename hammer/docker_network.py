@@ -11,16 +11,34 @@ starts becoming very noticeable (several seconds) and seems to grow with O(N^2)
 together with the number of iptables rules, because docker creates iptables rules
 from each bridge to each bridge.
 This is not an issue when creating `--internal` networks, so prefer that when possible.
+
+Networks created by the allocator are labelled, so networks which are no longer
+used can be removed with `remove_stale_docker_networks` to keep the number of bridges low.
+
+To avoid waiting for network creation in time critical places, a warm pool of networks
+can be created beforehand (or in the background) with `fill_docker_network_pool`. Jobs then
+take an idle network from the pool with `acquire_docker_network` and give it back with
+`release_docker_network`. Docker networks can't be renamed, so pool networks keep their
+pool names and `create_docker_network` (which creates a network with the given name)
+does not use the pool.
 """
 from __future__ import unicode_literals, absolute_import
+import json
+import re
+import uuid
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
 from subprocess import check_output, CalledProcessError
-from collections import deque
 from itertools import chain
-from ipaddress import IPv4Network, IPv4Interface
+from ipaddress import IPv4Address, IPv4Network, IPv4Interface
 
-from hammer.util import as_str, is_fabric1
+from hammer.util import as_str, is_fabric1, shell_quote
 
-__all__ = ['create_docker_network', 'DockerNetworkAllocator', 'OutOfNetworks']
+__all__ = [
+    'create_docker_network', 'remove_stale_docker_networks',
+    'fill_docker_network_pool', 'acquire_docker_network', 'release_docker_network',
+    'DockerNetworkAllocator', 'NetworkIndex', 'NetworkSnapshot', 'OutOfNetworks',
+]
 
 
 DEFAULT_NETWORK_POOL = (
@@ -28,11 +46,470 @@ DEFAULT_NETWORK_POOL = (
     IPv4Network('172.16.0.0/12'),
     IPv4Network('192.168.0.0/20'))
 
+# Host-wide registry of subnets which were recently created (see DockerNetworkAllocator), only root can write to it
+DEFAULT_RESERVATION_DIR = '/run/tg-hammer/docker-networks'
+
+# Marker printed by the reservation script when some subnets were already reserved by someone else
+RESERVATION_CONFLICT = 'tg-hammer-reservation-conflict:'
+
+# Marker printed by the reservation script when docker refused some subnets since they overlap existing networks
+NETWORK_OVERLAP = 'tg-hammer-network-overlap:'
+
+# Labels of networks created by the allocator (the creation time is a unix timestamp of the host)
+ALLOCATOR_LABEL = 'tg-hammer.allocator'
+CREATED_LABEL = 'tg-hammer.created'
+
+# Networks of the warm pool (see DockerNetworkAllocator.fill_warm_pool) have this label and name prefix
+WARM_POOL_LABEL = 'tg-hammer.pool'
+# ... and labels with the options they were created with, so jobs only get the kind of network they asked for
+WARM_POOL_INTERNAL_LABEL = 'tg-hammer.pool.internal'
+WARM_POOL_NETWORK_PREFIX_LABEL = 'tg-hammer.pool.prefix'
+WARM_POOL_PREFIX = 'tg-hammer-pool-'
+_warm_pool_name_re = re.compile(r'^[A-Za-z0-9_.-]+\Z')
+
+# Host-wide registry of warm pool networks which are in use, only root can write to it
+DEFAULT_WARM_POOL_DIR = '/run/tg-hammer/docker-network-pool'
+
+# Marker of the claims (and their age) in the output of DockerNetworkAllocator.stale_networks
+CLAIM_MARKER = '#tg-hammer-claim'
+
+
+# Allocation policies (see DockerNetworkAllocator)
+FIRST_FIT = 'first-fit'
+BEST_FIT = 'best-fit'
+POLICIES = (FIRST_FIT, BEST_FIT)
+
 
 class OutOfNetworks(RuntimeError):
     pass
 
 
+def make_network(address, prefix):
+    """
+    Build a network from its first address (as integer) and prefix length
+
+    Note: IPv4Network((address, prefix)) is not supported by the python 2 backport of ipaddress
+
+    Returns:
+        IPv4Network
+    """
+    return IPv4Network('%s/%d' % (IPv4Address(address), prefix))
+
+
+def _reservation_name(network):
+    """
+    Name of the reservation of a subnet (see DockerNetworkAllocator)
+
+    Returns:
+        str
+    """
+    return network.exploded.replace('/', '_')
+
+
+def _reservation_network(name):
+    """
+    Subnet of a reservation (see _reservation_name)
+
+    Returns:
+        Optional[IPv4Network]: None if the name is not a reservation (e.g. something else in the registry)
+    """
+    try:
+        return IPv4Network(name.replace('_', '/'))
+
+    except ValueError:
+        return None
+
+
+class NetworkIndex(object):
+    def __init__(self, pool, used_networks=()):
+        """
+        Free space index over a pool of networks
+
+        Used address ranges are kept as sorted, merged integer intervals and the free space between
+        them as sorted lists of aligned free blocks per prefix, so finding a free network is a lookup
+        of the first block of a few lists instead of checking every subnet of the pool.
+
+        Arguments:
+            pool(List[IPv4Network]): Pool of networks to assign from
+            used_networks(Iterable[IPv4Network]): Networks which are already in use
+        """
+        self.pool = list(sorted(pool))
+
+        self._starts = []
+        self._ends = []
+
+        # prefix -> sorted start addresses of the free blocks with the prefix (see _split), built on first use
+        self._blocks = None
+
+        # Bulk load: sort once and merge in a single pass
+        for start, end in sorted(self._bounds(network) for network in used_networks):
+            if self._ends and start <= self._ends[-1] + 1:
+                self._ends[-1] = max(self._ends[-1], end)
+
+            else:
+                self._starts.append(start)
+                self._ends.append(end)
+
+    @staticmethod
+    def _bounds(network):
+        return int(network.network_address), int(network.broadcast_address)
+
+    def reserve(self, network):
+        """
+        Mark a network as used
+
+        Arguments:
+            network(IPv4Network): Network to reserve
+        """
+        start, end = self._bounds(network)
+
+        # Free ranges which lose addresses, their blocks are replaced by the blocks of what is left of them
+        gaps = []
+
+        if self._blocks is not None:
+            gaps = [gap for pool_network in self.pool for gap in self._gaps(pool_network, start, end)]
+
+            for gap_start, gap_end in gaps:
+                self._update_blocks(gap_start, gap_end, remove=True)
+
+        used_start, used_end = start, end
+
+        # Merge with all intervals which overlap or touch the new one
+        first = bisect_left(self._ends, start - 1)
+        last = bisect_right(self._starts, end + 1)
+
+        if first < last:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+        for gap_start, gap_end in gaps:
+            if gap_start < used_start:
+                self._update_blocks(gap_start, min(gap_end, used_start - 1))
+
+            if gap_end > used_end:
+                self._update_blocks(max(gap_start, used_end + 1), gap_end)
+
+    def _free_lists(self):
+        if self._blocks is None:
+            self._blocks = {}
+
+            for network in self.pool:
+                for start, prefix in self._free_blocks(network):
+                    self._blocks.setdefault(prefix, []).append(start)
+
+            for blocks in self._blocks.values():
+                blocks.sort()
+
+        return self._blocks
+
+    def _update_blocks(self, start, end, remove=False):
+        for block_start, prefix in self._split(start, end):
+            blocks = self._blocks.setdefault(prefix, [])
+
+            if remove:
+                del blocks[bisect_left(blocks, block_start)]
+
+            else:
+                insort(blocks, block_start)
+
+    def is_free(self, network):
+        start, end = self._bounds(network)
+        index = bisect_right(self._starts, end) - 1
+
+        return index < 0 or self._ends[index] < start
+
+    def used_ranges(self):
+        """
+        Returns:
+            List[Tuple[int, int]]: Merged used address ranges (first and last address as integers)
+        """
+        return list(zip(self._starts, self._ends))
+
+    def find(self, prefix):
+        """
+        Find the first free network with the given prefix
+
+        Every free aligned block with the prefix is part of a free block of the same or a larger size (see _split),
+        so the first one starts where the first free block of any of these sizes starts. This looks at the first
+        block of at most one list per prefix (see find_best).
+
+        Arguments:
+            prefix(int): Network prefix length (e.g. `24` for `/24`)
+
+        Returns:
+            Optional[IPv4Network]: Free network or None if the pool is exhausted
+        """
+        blocks = self._free_lists()
+        starts = [blocks[block_prefix][0] for block_prefix in range(prefix + 1) if blocks.get(block_prefix)]
+
+        return make_network(min(starts), prefix) if starts else None
+
+    def find_best(self, prefix):
+        """
+        Find a free network with the given prefix from the smallest free block that can hold it
+
+        Free space is split into the largest aligned blocks possible (like a buddy allocator), the network
+        is taken from the smallest of the blocks that fit (the first one of them if there are several).
+        This keeps large blocks free for later large requests when networks of different sizes are mixed.
+
+        The free blocks are kept in a sorted list per prefix (built on first use and updated by reserve),
+        so this only looks at the first block of at most one list per prefix.
+
+        Arguments:
+            prefix(int): Network prefix length (e.g. `24` for `/24`)
+
+        Returns:
+            Optional[IPv4Network]: Free network or None if the pool is exhausted
+        """
+        blocks = self._free_lists()
+
+        for block_prefix in range(prefix, -1, -1):
+            if blocks.get(block_prefix):
+                return make_network(blocks[block_prefix][0], prefix)
+
+        return None
+
+    def _gaps(self, network, low=None, high=None):
+        """
+        Free address ranges of a pool network (ordered by address)
+
+        Arguments:
+            low(Optional[int]): Only the ranges which end at or after this address
+            high(Optional[int]): Only the ranges which start at or before this address
+
+        Returns:
+            Iterator[Tuple[int, int]]: First and last address of each range (as integers)
+        """
+        start, pool_end = self._bounds(network)
+        low = start if low is None else max(low, start)
+        high = pool_end if high is None else min(high, pool_end)
+
+        if low > high:
+            return
+
+        # The first used interval which ends at or after low, the range before it starts after the previous one
+        index = bisect_left(self._ends, low)
+
+        if index > 0:
+            start = max(start, self._ends[index - 1] + 1)
+
+        while index < len(self._starts) and self._starts[index] <= pool_end:
+            if start > high:
+                return
+
+            if start < self._starts[index] and self._starts[index] > low:
+                yield start, self._starts[index] - 1
+
+            start = self._ends[index] + 1
+            index += 1
+
+        if start <= min(pool_end, high):
+            yield start, pool_end
+
+    @staticmethod
+    def _split(start, end):
+        """
+        Split an address range into the largest possible aligned blocks
+
+        Returns:
+            Iterator[Tuple[int, int]]: Block start address (as integer) and prefix length
+        """
+        while start <= end:
+            size = start & -start if start else 2 ** 32
+
+            while start + size - 1 > end:
+                size //= 2
+
+            yield start, 33 - size.bit_length()
+            start += size
+
+    def _free_blocks(self, network):
+        return chain.from_iterable(self._split(start, end) for start, end in self._gaps(network))
+
+    def fragmentation(self):
+        """
+        Free space report of the pool
+
+        Returns:
+            List[dict]: For each pool network: `network`, `free` (number of free addresses),
+            `largest` (largest free block as IPv4Network, None if full) and `blocks` (number of
+            free blocks by prefix length, e.g. `{24: 3, 20: 1}`)
+        """
+        report = []
+
+        for network in self.pool:
+            free = 0
+            largest = None
+            blocks = {}
+
+            for start, prefix in self._free_blocks(network):
+                free += 2 ** (32 - prefix)
+                blocks[prefix] = blocks.get(prefix, 0) + 1
+
+                if largest is None or prefix < largest[1]:
+                    largest = (start, prefix)
+
+            report.append({
+                'network': network,
+                'free': free,
+                'largest': make_network(*largest) if largest is not None else None,
+                'blocks': blocks,
+            })
+
+        return report
+
+
+class NetworkSnapshot(object):
+    SECTION_MARKER = '#tg-hammer:'
+
+    # Printed after each section with the exit status of its command
+    STATUS_MARKER = '#tg-hammer:rc '
+
+    def __init__(self, interfaces=(), routes=(), docker_networks=None, reserved=(), claimed=()):
+        """
+        Networks in use on a host, gathered with a single command (see `command` and `parse`)
+
+        Arguments:
+            interfaces(List[IPv4Network]): Networks of the local ipv4 addresses
+            routes(List[IPv4Network]): Routed ipv4 networks
+            docker_networks(Dict[str, List[IPv4Network]]): Existing docker networks and their ipv4 subnets
+            reserved(List[IPv4Network]): Subnets reserved by other jobs (see DockerNetworkAllocator)
+            claimed(List[str]): Warm pool networks which are in use
+        """
+        self.interfaces = list(interfaces)
+        self.routes = list(routes)
+        self.docker_networks = OrderedDict(docker_networks or ())
+        self.reserved = list(reserved)
+        self.claimed = list(claimed)
+
+    def used_networks(self):
+        """
+        Returns:
+            Iterator[IPv4Network]: Networks used by interfaces, routes and docker networks (even the ones without a route)
+        """
+        return chain(self.interfaces, self.routes, chain.from_iterable(self.docker_networks.values()))
+
+    @classmethod
+    def _sections(cls, reservation_dir=None, warm_pool_dir=None):
+        """
+        Commands of the snapshot sections
+
+        Uses json output (`ip -j`) when available, falls back to the text output of older iproute2 versions.
+
+        Returns:
+            List[Tuple[str, str]]: Section name and command
+        """
+        sections = [
+            ('addr', "ip -j -4 addr show 2>/dev/null || "
+                     "{ out=$(ip -4 addr show) && echo \"$out\" | awk '$1 == \"inet\" { print $2 }'; }"),
+            ('route', "ip -j -4 route list 2>/dev/null || "
+                      "{ out=$(ip -4 route list) && echo \"$out\" | awk '/^[0-9]/ { print $1 }'; }"),
+            # Networks removed between ls and inspect are skipped
+            ('docker', "names=$(docker network ls -q) && { echo \"$names\" | "
+                       "xargs -r docker network inspect --format '{{.Name}} {{json .IPAM.Config}}' 2>/dev/null; true; }"),
+        ]
+
+        # The registries are created on first use
+        if reservation_dir is not None:
+            sections.append(('reserved', "if [ -d '{0}' ]; then ls -1 '{0}'; fi".format(reservation_dir)))
+
+        if warm_pool_dir is not None:
+            sections.append(('claimed', "if [ -d '{0}' ]; then ls -1 '{0}'; fi".format(warm_pool_dir)))
+
+        return sections
+
+    @classmethod
+    def command(cls, reservation_dir=None, warm_pool_dir=None):
+        """
+        Shell command which prints everything the snapshot needs, each section is followed by its exit status
+        """
+        return '; '.join(
+            "echo '{marker}{name}'; {cmd}; echo \"{status}$?\"".format(
+                marker=cls.SECTION_MARKER, name=name, cmd=cmd, status=cls.STATUS_MARKER)
+            for name, cmd in cls._sections(reservation_dir, warm_pool_dir))
+
+    @classmethod
+    def parse(cls, output):
+        """
+        Parse the output of `command`
+
+        Raises:
+            CalledProcessError: if the command of a section failed (an empty snapshot would make
+                the allocator hand out networks which are in use)
+
+        Returns:
+            NetworkSnapshot
+        """
+        sections = {}
+        name = None
+
+        for line in as_str(output).split('\n'):
+            line = line.strip()
+
+            if line.startswith(cls.STATUS_MARKER):
+                returncode = int(line[len(cls.STATUS_MARKER):])
+
+                if returncode != 0:
+                    commands = dict(cls._sections())
+                    raise CalledProcessError(returncode=returncode, cmd=commands.get(name, name),
+                                             output='\n'.join(sections.get(name, [])))
+
+            elif line.startswith(cls.SECTION_MARKER):
+                name = line[len(cls.SECTION_MARKER):]
+                sections[name] = []
+
+            elif line and name is not None:
+                sections[name].append(line)
+
+        return cls(
+            interfaces=cls._parse_addr(sections.get('addr', [])),
+            routes=cls._parse_route(sections.get('route', [])),
+            docker_networks=cls._parse_docker(sections.get('docker', [])),
+            reserved=[x for x in map(_reservation_network, sections.get('reserved', [])) if x is not None],
+            claimed=sections.get('claimed', []))
+
+    @staticmethod
+    def _parse_addr(lines):
+        if lines and lines[0].startswith('['):
+            return [
+                IPv4Interface('{}/{}'.format(info['local'], info['prefixlen'])).network
+                for interface in json.loads(''.join(lines))
+                for info in interface.get('addr_info', [])
+                if info.get('family', 'inet') == 'inet' and 'local' in info
+            ]
+
+        return [IPv4Interface(inet).network for inet in lines]
+
+    @staticmethod
+    def _parse_route(lines):
+        if lines and lines[0].startswith('['):
+            destinations = [route.get('dst', '') for route in json.loads(''.join(lines))]
+
+        else:
+            destinations = lines
+
+        # Skips `default` and route types like `blackhole 10.1.0.0/16`
+        return [IPv4Network(dst) for dst in destinations if dst[:1].isdigit()]
+
+    @staticmethod
+    def _parse_docker(lines):
+        networks = OrderedDict()
+
+        for line in lines:
+            name, _, config = line.partition(' ')
+
+            networks[name] = [
+                IPv4Network(subnet['Subnet'])
+                for subnet in json.loads(config or 'null') or []
+                if ':' not in subnet.get('Subnet', ':')
+            ]
+
+        return networks
+
+
 def remote_cmd(cmd, context=None):
     if is_fabric1:
         from fabric.api import sudo
@@ -62,29 +539,98 @@ def local_cmd(cmd, context=None):
 def create_docker_network(name, internal=False, cmd=remote_cmd, prefix=24, pool=None, context=None):
     """
     Note: With fabric2 the context argument must be set to is Connection
+
+    Note: The warm pool is not used, its networks can't be renamed to `name` (see acquire_docker_network)
     """
     allocator = DockerNetworkAllocator(cmd, context=context, pool=pool)
     return allocator.create(name, internal=internal, prefix=prefix)
 
 
+def remove_stale_docker_networks(ttl=24 * 60 * 60, cmd=remote_cmd, context=None):
+    """
+    Remove networks created by the allocator which have no containers and are older than ttl (in seconds)
+
+    Note: With fabric2 the context argument must be set to is Connection
+    """
+    allocator = DockerNetworkAllocator(cmd, context=context)
+    return allocator.remove_stale(ttl=ttl)
+
+
+def fill_docker_network_pool(size, internal=True, cmd=remote_cmd, prefix=24, pool=None, context=None, background=False):
+    """
+    Make sure there are at least `size` idle networks in the warm pool
+
+    Note: With fabric2 the context argument must be set to is Connection
+    """
+    allocator = DockerNetworkAllocator(cmd, context=context, pool=pool)
+    return allocator.fill_warm_pool(size, internal=internal, prefix=prefix, background=background)
+
+
+def acquire_docker_network(internal=True, cmd=remote_cmd, prefix=24, pool=None, context=None):
+    """
+    Take an idle network from the warm pool (a new one is created if the pool is empty)
+
+    Note: With fabric2 the context argument must be set to is Connection
+    """
+    allocator = DockerNetworkAllocator(cmd, context=context, pool=pool)
+    return allocator.acquire_network(internal=internal, prefix=prefix)
+
+
+def release_docker_network(name, cmd=remote_cmd, context=None):
+    """
+    Return a network taken with acquire_docker_network to the warm pool
+
+    Note: With fabric2 the context argument must be set to is Connection
+    """
+    allocator = DockerNetworkAllocator(cmd, context=context)
+    return allocator.release_network(name)
+
+
 class DockerNetworkAllocator(object):
-    def __init__(self, cmd, context=None, pool=None):
+    def __init__(self, cmd, context=None, pool=None, reservation_dir=DEFAULT_RESERVATION_DIR, reservation_ttl=10,
+                 max_attempts=32, warm_pool_dir=DEFAULT_WARM_POOL_DIR, policy=FIRST_FIT):
         """
         Docker network allocator
 
+        Subnets are reserved on the host (`mkdir` of `<reservation_dir>/<subnet>`, which is atomic) in the same command
+        that creates the networks, so parallel jobs on the same host never create networks with the same subnet.
+        The reservations are kept for `reservation_ttl` minutes, so jobs which read the host before the network
+        was created can't take the subnet either. When another job got there first (or docker reports that the
+        subnet overlaps a network the allocator didn't know about) the allocator picks the next free subnet
+        and tries again.
+
         Arguments:
             cmd(Callable[str, str]): Call a command
             pool(List[IPv4Network]): Pool of networks to assign from
+            reservation_dir(Optional[str]): Directory of the host-wide reservations, None disables reservations
+            reservation_ttl(int): How long (in minutes) reservations are kept, older ones are removed
+            max_attempts(int): How many times to retry when the assigned subnets were reserved by another job
+            warm_pool_dir(str): Directory of the host-wide registry of warm pool networks which are in use
+            policy(str): `first-fit` takes the first free network, `best-fit` takes it from the smallest free block
+                that fits (see NetworkIndex.find_best), which fragments the pool less when prefix sizes are mixed
         """
+        if policy not in POLICIES:
+            raise ValueError('Unknown allocation policy %r, expected one of: %s' % (policy, ', '.join(POLICIES)))
+
         self._cmd = cmd
         self._context = context
 
+        self.policy = policy
+        self.reservation_dir = reservation_dir
+        self.reservation_ttl = reservation_ttl
+        self.max_attempts = max_attempts
+        self.warm_pool_dir = warm_pool_dir
+
         if pool is None:
             pool = DEFAULT_NETWORK_POOL
 
         # Ensure it is sorted so we can be efficient when finding a free network
         self.pool = list(sorted(pool))
 
+        self._snapshot = None
+        self._index = None
+        self._existing = None
+
     def _docker(self, args):
         # lord have mercy
         cmd = ' '.join("'{}'".format(arg) for arg in chain(['docker'], args))
@@ -95,46 +641,80 @@ class DockerNetworkAllocator(object):
 
         return [line.strip() for line in output.split('\n')]
 
+    @property
+    def snapshot(self):
+        """
+        Networks in use on the host, read with a single command on the first access and reused by later
+        allocations (see refresh)
+
+        Returns:
+            NetworkSnapshot
+        """
+        if self._snapshot is None:
+            output = self._cmd(NetworkSnapshot.command(self.reservation_dir, self.warm_pool_dir), context=self._context)
+            self._snapshot = NetworkSnapshot.parse(output)
+
+        return self._snapshot
+
     def _networks_in_use(self):
-        return list(chain(
-            (
-                # Locally used networks
-                IPv4Interface(inet).network
-                for inet in self._cmd("ip -4 addr | grep 'inet ' | awk '{ print $2 }'", context=self._context).split()
-                if inet != ''
-            ),
-            (
-                # Already routed ipv4 networks
-                IPv4Network(network)
-                for network in self._cmd("ip -4 route list | grep '^[0-9]' | awk '{ print $1 }'", context=self._context).split()
-                if network != ''
-            )
-        ))
+        return list(self.snapshot.used_networks())
 
-    def _proposed_network(self, prefix):
-        networks_in_pool = (
-            subnet
-            for network in self.pool
-            for subnet in network.subnets(new_prefix=prefix)
-        )
+    def _reserved_networks(self):
+        return list(self.snapshot.reserved)
+
+    @property
+    def index(self):
+        """
+        Free space index of the pool, built from the networks in use (and reserved by other jobs) on the first access
+
+        Returns:
+            NetworkIndex
+        """
+        if self._index is None:
+            self._index = NetworkIndex(self.pool, chain(self._networks_in_use(), self._reserved_networks()))
+
+        return self._index
+
+    def refresh(self):
+        """
+        Forget the networks in use (and networks assigned by this allocator) and the existing docker networks,
+        they are read again on next use
+        """
+        self._snapshot = None
+        self._index = None
+        self._existing = None
 
-        used_networks = deque(sorted(self._networks_in_use()))
+    def existing_networks(self):
+        """
+        Names of existing docker networks, read once per allocator (see refresh)
+
+        Returns:
+            Set[str]
+        """
+        if self._existing is None:
+            self._existing = set(self.snapshot.docker_networks)
 
-        for network in networks_in_pool:
+        return self._existing
 
-            # This while block is purely for optimization,
-            # due to sorting of both networks_in_pool and used_networks
-            # this used network can never interfere again, so don't waste time on it.
-            while used_networks and \
-                    used_networks[0].broadcast_address < network.network_address and \
-                    not network.overlaps(used_networks[0]):
-                used_networks.popleft()
+    def _proposed_network(self, prefix):
+        if self.policy == BEST_FIT:
+            return self.index.find_best(prefix)
 
-            if not any(network.overlaps(used) for used in used_networks):
-                return network
+        return self.index.find(prefix)
+
+    def fragmentation_report(self):
+        """
+        Free space of the pool (see NetworkIndex.fragmentation)
+
+        Returns:
+            List[dict]
+        """
+        return self.index.fragmentation()
 
     def assign(self, prefix=24):
         """
+        Assign a free network, networks assigned by the same allocator never overlap
+
         Arguments:
             prefix_length(int): Network prefix length  (e.g. `24`  for `/24`)
         """
@@ -143,8 +723,23 @@ class DockerNetworkAllocator(object):
         if proposed_network is None:
             raise OutOfNetworks("Out of networks, contact your server administrator")
 
+        self.index.reserve(proposed_network)
+
         return proposed_network
 
+    def assign_many(self, count, prefix=24):
+        """
+        Assign several free networks at once
+
+        Arguments:
+            count(int): Number of networks to assign
+            prefix_length(int): Network prefix length  (e.g. `24`  for `/24`)
+
+        Returns:
+            List[IPv4Network]
+        """
+        return [self.assign(prefix=prefix) for _ in range(count)]
+
     def create(self, name, internal=False, prefix=24):
         """
         Create a new docker network if it does not already exist
@@ -157,15 +752,353 @@ class DockerNetworkAllocator(object):
         Returns:
             bool: True if network was created, False if it already existed
         """
-        existing = self._docker(['network', 'ls', '--format', '{{.Name}}'])
-
-        if name in existing:
+        if name in self.existing_networks():
             return False
 
-        cmd = chain(
-            ('docker', 'network', 'create'),
-            ('--internal',) if internal else (),
-            ('--subnet', self.assign(prefix=prefix).exploded, name))
-        self._cmd(' '.join(cmd), context=self._context)
+        self.create_many([name], internal=internal, prefix=prefix)
 
         return True
+
+    def create_many(self, names, internal=False, prefix=24, labels=(), claim=False):
+        """
+        Create several docker networks (the ones that don't exist yet) with a single command
+
+        Existing networks and used ranges are read once (see snapshot), all subnets are assigned in one pass
+        and reserving the subnets and the `docker network create` commands are chained into one remote call.
+
+        Arguments:
+            names(Iterable[str]): Network names
+            internal(bool): Internal networks (--internal)
+            prefix(int): Network prefix
+            labels(Iterable[str]): Extra labels of the networks
+            claim(bool): Claim the networks in the warm pool registry (see acquire_network) in the same command,
+                before they are created
+
+        Returns:
+            OrderedDict[str, Optional[IPv4Network]]: Subnet of each network, None if the network already existed
+        """
+        existing = self.existing_networks()
+        result = OrderedDict()
+
+        for name in names:
+            if name not in result:
+                result[name] = None if name in existing else self.assign(prefix=prefix)
+
+        pending = OrderedDict((name, subnet) for name, subnet in result.items() if subnet is not None)
+
+        for _ in range(self.max_attempts):
+            if not pending:
+                break
+
+            conflicts, overlaps = self._create_reserved(pending, internal, labels, claim=claim)
+            failed = conflicts | overlaps
+
+            self.existing_networks().update(name for name, subnet in pending.items() if subnet not in failed)
+            pending = OrderedDict((name, subnet) for name, subnet in pending.items() if subnet in failed)
+
+            if overlaps:
+                # Networks were created after we read the host, read it again
+                self.refresh()
+
+            # Another job reserved (or used) these subnets first, try the next free ones
+            for name in pending:
+                result[name] = pending[name] = self.assign(prefix=prefix)
+
+        else:
+            if pending:
+                raise OutOfNetworks("Could not reserve networks in %d attempts" % self.max_attempts)
+
+        return result
+
+    def _create_reserved(self, networks, internal, labels=(), claim=False):
+        """
+        Reserve the subnets on the host and create the networks in a single command
+
+        Networks whose subnet is already reserved (or overlaps an existing network) are not created,
+        the other ones are.
+
+        Arguments:
+            networks(Dict[str, IPv4Network]): Subnet of each network to create
+
+        Returns:
+            Tuple[Set[IPv4Network], Set[IPv4Network]]: Subnets which were already reserved by someone else and
+                subnets which overlap existing networks
+        """
+        output = as_str(self._cmd(self._create_reserved_cmd(networks, internal, labels, claim), context=self._context))
+        conflicts, overlaps = set(), set()
+
+        for line in output.split('\n'):
+            if line.startswith(RESERVATION_CONFLICT):
+                conflicts.update(map(_reservation_network, line[len(RESERVATION_CONFLICT):].split()))
+
+            elif line.startswith(NETWORK_OVERLAP):
+                overlaps.update(map(_reservation_network, line[len(NETWORK_OVERLAP):].split()))
+
+        return conflicts, overlaps
+
+    def _create_reserved_cmd(self, networks, internal, labels=(), claim=False):
+        claim_cmd = self._claim_cmd(networks) if claim else ''
+
+        if self.reservation_dir is None:
+            return claim_cmd + ' && '.join(
+                self._create_cmd(name, subnet, internal, labels) for name, subnet in networks.items())
+
+        return claim_cmd + self._reserve_cmd(networks, internal, labels)
+
+    def _claim_cmd(self, names):
+        # mkdir -p since the networks are claimed again when they are retried with another subnet
+        return "({cd}mkdir -p {names}) || exit 1; ".format(
+            cd=self._cd_cmd(self.warm_pool_dir), names=' '.join("'{}'".format(name) for name in names))
+
+    def _reserve_cmd(self, networks, internal, labels=()):
+        # The reservation is kept after the network is created: jobs which read the host before that would
+        # otherwise be able to reserve the subnet again
+        create = ''.join(
+            "if mkdir '{name}' 2>/dev/null; then "
+            "out=$({command} 2>&1) || case \"$out\" in "
+            "*overlap*) rmdir '{name}'; overlaps=\"$overlaps {name}\";; "
+            "*) rmdir '{name}'; echo \"$out\" >&2; rc=1;; "
+            "esac; "
+            "else conflicts=\"$conflicts {name}\"; fi; ".format(
+                name=_reservation_name(subnet), command=self._create_cmd(name, subnet, internal, labels))
+            for name, subnet in networks.items())
+
+        return self._cd_cmd(self.reservation_dir) + (
+            # Forget old reservations, the networks are visible to other jobs by now (or the job died)
+            "find . -mindepth 1 -maxdepth 1 -type d -mmin +{ttl} -exec rmdir {{}} + 2>/dev/null; "
+            "rc=0; conflicts=''; overlaps=''; "
+            "{create}"
+            "echo '{conflict}'$conflicts; echo '{overlap}'$overlaps; exit $rc"
+        ).format(ttl=self.reservation_ttl, create=create, conflict=RESERVATION_CONFLICT, overlap=NETWORK_OVERLAP)
+
+    def stale_networks(self, ttl=24 * 60 * 60):
+        """
+        Find networks created by the allocator which have no containers and are older than ttl
+
+        Idle warm pool networks are kept, but pool networks which were claimed more than ttl ago and have
+        no containers are stale (the job which took it died or did not release it).
+
+        Arguments:
+            ttl(int): Minimum age of the networks (or of the claims of warm pool networks) in seconds
+
+        Returns:
+            List[str]: Network names
+        """
+        output = as_str(self._cmd(
+            "date +%s; docker network ls -q --filter 'label={allocator}' | xargs -r docker network inspect "
+            "--format '{{{{.Name}}}} {{{{index .Labels \"{created}\"}}}} {{{{len .Containers}}}}'; "
+            "find '{warm_pool_dir}' -mindepth 1 -maxdepth 1 -type d -printf '{marker} %f %Ts\\n' 2>/dev/null; true".format(
+                allocator=ALLOCATOR_LABEL, created=CREATED_LABEL, warm_pool_dir=self.warm_pool_dir,
+                marker=CLAIM_MARKER),
+            context=self._context)).split('\n')
+
+        # Use the clock of the host, the labels (and claims) were created with it
+        now = int(output[0].strip())
+        networks = []
+        claims = {}
+
+        for line in output[1:]:
+            parts = line.split()
+
+            if len(parts) != 3 or not parts[2].isdigit():
+                continue
+
+            if parts[0] == CLAIM_MARKER:
+                claims[parts[1]] = int(parts[2])
+
+            elif parts[1].isdigit():
+                networks.append(parts)
+
+        stale = []
+
+        for name, created, containers in networks:
+            if containers != '0':
+                continue
+
+            if name.startswith(WARM_POOL_PREFIX):
+                # Idle warm pool networks are kept on purpose
+                if name in claims and now - claims[name] >= ttl:
+                    stale.append(name)
+
+            elif now - int(created) >= ttl:
+                stale.append(name)
+
+        return stale
+
+    def remove_stale(self, ttl=24 * 60 * 60):
+        """
+        Remove networks created by the allocator which have no containers and are older than ttl,
+        all of them are removed with a single `docker network rm`
+
+        Networks which got a container in the meantime are left alone (docker refuses to remove them).
+
+        Arguments:
+            ttl(int): Minimum age of the networks (in seconds)
+
+        Returns:
+            List[str]: Names of the removed networks
+        """
+        stale = self.stale_networks(ttl=ttl)
+
+        if not stale:
+            return []
+
+        # docker network rm prints the names of the removed networks and fails if any of them couldn't be removed
+        output = self._cmd(
+            ' '.join(chain(['docker', 'network', 'rm'], ("'{}'".format(name) for name in stale))) + ' 2>/dev/null; true',
+            context=self._context)
+        removed = set(as_str(output).split())
+
+        # Forget the claims of removed warm pool networks
+        claims = [name for name in stale if name in removed and name.startswith(WARM_POOL_PREFIX)]
+
+        if claims:
+            self._cmd(' '.join(chain(['rmdir'], (shell_quote('{}/{}'.format(self.warm_pool_dir, name)) for name in claims))),
+                      context=self._context)
+
+        # The subnets are free again
+        self.refresh()
+
+        return [name for name in stale if name in removed]
+
+    @staticmethod
+    def _warm_pool_labels(internal, prefix):
+        return [
+            WARM_POOL_LABEL,
+            '{}={}'.format(WARM_POOL_INTERNAL_LABEL, 'true' if internal else 'false'),
+            '{}={}'.format(WARM_POOL_NETWORK_PREFIX_LABEL, prefix),
+        ]
+
+    def warm_pool_networks(self, internal=None, prefix=None):
+        """
+        Warm pool networks on the host (read from the snapshot)
+
+        When internal and prefix are given, only the networks created with these options are returned
+        (this needs an extra command, the snapshot does not have the labels).
+
+        Arguments:
+            internal(Optional[bool]): Internal networks (--internal)
+            prefix(Optional[int]): Network prefix
+
+        Returns:
+            Tuple[List[str], List[str]]: Names of the idle networks and of the networks in use
+        """
+        claimed = set(self.snapshot.claimed)
+
+        if internal is None or prefix is None:
+            names = [name for name in self.existing_networks() if name.startswith(WARM_POOL_PREFIX)]
+
+        else:
+            names = self._docker(chain(
+                ['network', 'ls'],
+                chain.from_iterable(('--filter', 'label=' + label) for label in self._warm_pool_labels(internal, prefix)),
+                ['--format', '{{.Name}}']))
+
+        return sorted(x for x in names if x not in claimed), sorted(x for x in names if x in claimed)
+
+    def fill_warm_pool(self, size, internal=True, prefix=24, background=False):
+        """
+        Create networks for the warm pool (in a single command) until it has at least `size` idle networks
+
+        Meant to be called outside of the time critical parts of a job (e.g. when the job has finished,
+        or from a periodic maintenance task). With `background` the networks are created by a detached
+        process on the host and the call returns right away, networks which can't be created (e.g. since
+        another job took the subnet) are skipped and created by the next fill.
+
+        Arguments:
+            size(int): Number of idle networks to keep
+            internal(bool): Internal networks (--internal), recommended since those are cheaper to create
+            prefix(int): Network prefix
+            background(bool): Create the networks in the background
+
+        Returns:
+            List[str]: Names of the created networks (of the networks being created with `background`)
+        """
+        idle, _ = self.warm_pool_networks(internal=internal, prefix=prefix)
+        names = [self._warm_pool_name() for _ in range(size - len(idle))]
+        labels = self._warm_pool_labels(internal, prefix)
+
+        if names and background:
+            networks = OrderedDict((name, self.assign(prefix=prefix)) for name in names)
+            self._cmd('setsid nohup sh -c %s >/dev/null 2>&1 </dev/null &' % shell_quote(
+                self._create_reserved_cmd(networks, internal, labels)), context=self._context)
+
+        elif names:
+            self.create_many(names, internal=internal, prefix=prefix, labels=labels)
+
+        return names
+
+    def acquire_network(self, internal=True, prefix=24):
+        """
+        Take an idle network from the warm pool
+
+        Docker networks can't be renamed or relabelled, so the network keeps its pool name (use the returned name)
+        and the claim is stored in the host-wide registry (`mkdir` of `<warm_pool_dir>/<name>`). All idle networks
+        are tried in a single command, so parallel jobs never get the same network. When the pool is empty,
+        a new pool network is claimed and created in a single command (claimed first, so no other job can take it).
+
+        Only networks which were created with the same options are taken from the pool.
+
+        Arguments:
+            internal(bool): Internal network (--internal)
+            prefix(int): Network prefix
+
+        Returns:
+            str: Network name
+        """
+        labels = self._warm_pool_labels(internal, prefix)
+        output = self._cmd(
+            self._cd_cmd(self.warm_pool_dir) + "for n in $(docker network ls {filters} --format '{{{{.Name}}}}'); do "
+            "if mkdir \"$n\" 2>/dev/null; then echo \"$n\"; exit 0; fi; "
+            "done; true".format(filters=' '.join("--filter 'label={}'".format(label) for label in labels)),
+            context=self._context)
+
+        name = as_str(output).strip()
+
+        if name:
+            return name
+
+        name = self._warm_pool_name()
+
+        try:
+            self.create_many([name], internal=internal, prefix=prefix, labels=labels, claim=True)
+
+        except Exception:
+            # Don't leave a claim of a network which does not exist
+            self.release_network(name)
+            raise
+
+        return name
+
+    def release_network(self, name):
+        """
+        Return a network taken with acquire_network to the warm pool, containers using it must be removed beforehand
+
+        Arguments:
+            name(str): Network name
+
+        Raises:
+            ValueError: if name is not a warm pool network
+        """
+        if not name.startswith(WARM_POOL_PREFIX) or not _warm_pool_name_re.match(name):
+            raise ValueError('Not a warm pool network: %r' % name)
+
+        self._cmd('rmdir %s' % shell_quote('{}/{}'.format(self.warm_pool_dir, name)), context=self._context)
+
+    @staticmethod
+    def _cd_cmd(directory):
+        # The registries are shared by all jobs on the host, but only root (the commands run with sudo) can change them
+        return "cd '{dir}' 2>/dev/null || {{ mkdir -p -m 0755 '{dir}' && cd '{dir}'; }} || exit 1; ".format(dir=directory)
+
+    @staticmethod
+    def _warm_pool_name():
+        return WARM_POOL_PREFIX + uuid.uuid4().hex[:12]
+
+    @staticmethod
+    def _create_cmd(name, subnet, internal, labels=()):
+        return ' '.join(chain(
+            ('docker', 'network', 'create'),
+            ('--internal',) if internal else (),
+            ('--label', ALLOCATOR_LABEL, '--label', '{}=$(date +%s)'.format(CREATED_LABEL)),
+            chain.from_iterable(('--label', label) for label in labels),
+            ('--subnet', subnet.exploded, name)))
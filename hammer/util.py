@@ -1,8 +1,46 @@
+import os
+import re
 import sys
 
-try:
-    import fabric.version  # NOQA
 
+def _find_package_dir(name):
+    """ Find the directory of a package without importing it
+    """
+    try:
+        from importlib.util import find_spec
+
+    except ImportError:  # pragma: no cover
+        import imp
+
+        try:
+            return imp.find_module(name)[1]
+
+        except ImportError:
+            return None
+
+    try:
+        spec = find_spec(name)
+
+    except (ImportError, ValueError):  # pragma: no cover
+        return None
+
+    if spec is None or not spec.submodule_search_locations:
+        return None
+
+    return list(spec.submodule_search_locations)[0]
+
+
+def _detect_fabric1():
+    # Importing fabric2 (and paramiko) is slow, so fabric1 is detected by its fabric/version.py module instead
+    if 'fabric.version' in sys.modules:
+        return True
+
+    package_dir = _find_package_dir('fabric')
+
+    return package_dir is not None and os.path.exists(os.path.join(package_dir, 'version.py'))
+
+
+if _detect_fabric1():
     is_fabric1 = True
 
     # This way we can have a single `expect UnexpectedExit` statement instead of having two separate code paths for fabric1/fabric2
@@ -11,15 +49,28 @@ try:
     # This way we can have a single `expect Exit` when asserting for `abort` during tests
     Exit = SystemExit
 
-except ImportError:
+else:
     from invoke.exceptions import UnexpectedExit  # NOQA
 
     is_fabric1 = False
 
 
 if is_fabric1:
-    from fabric.api import abort, prompt
-    from fabric.utils import indent
+    # fabric.api is imported on first use
+    def abort(*args, **kwargs):
+        from fabric.api import abort as fabric_abort
+
+        return fabric_abort(*args, **kwargs)
+
+    def prompt(*args, **kwargs):
+        from fabric.api import prompt as fabric_prompt
+
+        return fabric_prompt(*args, **kwargs)
+
+    def indent(*args, **kwargs):
+        from fabric.utils import indent as fabric_indent
+
+        return fabric_indent(*args, **kwargs)
 
 else:
     from invoke.exceptions import Exit
@@ -60,6 +111,40 @@ else:
         return (" " * spaces) + text
 
 
+_safe_shell_chars = re.compile(r'^[a-zA-Z0-9_@%+=:,./-]+$')
+
+
+def shell_quote(val):
+    """ Quote a value so it can be safely used as a single argument in a shell command
+    """
+    val = as_str(val)
+
+    if not val:
+        return "''"
+
+    if _safe_shell_chars.match(val):
+        return val
+
+    return "'" + val.replace("'", "'\"'\"'") + "'"
+
+
+def command_failed(command, exited, stdout=''):
+    """ Signal that a remote command failed the same way fabric does it (abort on fabric1, UnexpectedExit on fabric2)
+    """
+    if is_fabric1:
+        try:
+            abort('run() received nonzero return code %s while executing!\n\nRequested: %s' % (exited, command))
+
+        except SystemExit:
+            # abort always exits with 1, keep the exit code of the command instead
+            raise SystemExit(exited)
+
+    else:
+        from invoke.runners import Result
+
+        raise UnexpectedExit(Result(stdout=stdout, command=command, exited=exited, hide=('stdout', 'stderr')))
+
+
 def as_str(val):
     if sys.version_info >= (3, 0):
         if isinstance(val, bytes):
@@ -1,8 +1,17 @@
-from .manager import VcsProxy as Vcs
+from .manager import LazyHandler, VcsProxy as Vcs
 from .base import BaseVcs
+from .cache import BranchCache
+from .changes import ChangeSet, FileChange
+from .group import VcsGroup, VcsGroupResult
 
 
 __all__ = [
     'Vcs',
     'BaseVcs',
+    'BranchCache',
+    'ChangeSet',
+    'FileChange',
+    'LazyHandler',
+    'VcsGroup',
+    'VcsGroupResult',
 ]
@@ -1,8 +1,12 @@
+import hashlib
+import posixpath
 import re
+import time
+import uuid
 
-import ftfy
+from hammer.util import command_failed, is_fabric1, shell_quote
 
-from hammer.util import is_fabric1
+from .changes import ChangeSet, filter_changes
 
 
 class SudoCWDContext(object):
@@ -20,6 +24,129 @@ class SudoCWDContext(object):
         self.vcs.cmd_cwd_stack.pop(-1)
 
 
+class BatchCommand(object):
+    """ Command queued in a RemoteBatch
+
+        After the batch is executed `exited` contains the exit code of the command and `stdout` its output. If an
+        earlier command in the batch failed (and the batch stops on errors) the command is not run and `exited`
+        stays None.
+    """
+
+    def __init__(self, command, raw=False, silent=True):
+        self.command = command
+        self.raw = raw
+        self.silent = silent
+        self.stdout = None
+        self.exited = None
+
+    @property
+    def ok(self):
+        return self.exited == 0
+
+    def result(self):
+        """ Get output of the command, fails the same way remote_cmd does if the command exited with a non-zero code
+
+        :rtype: str
+        """
+        if self.exited is None:
+            raise RuntimeError('Command was not executed: %s' % self.command)
+
+        if self.exited != 0:
+            command_failed(self.command, self.exited, stdout=self.stdout)
+
+        return self.stdout
+
+
+class RemoteBatch(object):
+    """ Queue of remote commands which are executed in a single remote shell invocation
+
+        Each command runs in its own subshell (so `cd` etc. does not leak into the next one). Its output and exit
+        code are framed with a unique marker so they can be separated from the combined output afterwards.
+
+        >>> batch = vcs.batch()
+        >>> fetch = batch.add('git fetch origin')
+        >>> log = batch.add('git log -n 1 origin/master')
+        >>> batch.execute()
+        >>> log.result()
+
+    :param stop_on_error: Do not run the remaining commands after one of them fails
+    """
+
+    def __init__(self, vcs_instance, stop_on_error=True):
+        self.vcs = vcs_instance
+        self.stop_on_error = stop_on_error
+
+        self.commands = []
+        self.marker = 'hammer-batch-%s' % uuid.uuid4().hex
+
+    def add(self, command, raw=False, silent=True):
+        """ Queue a command
+
+        :param raw: Keep the output of the command as is (see BaseVcs.cleanup_command_result)
+        :param silent: Do not print the output of the command after the batch is executed
+        :rtype: BatchCommand
+        """
+        command = BatchCommand(command, raw=raw, silent=silent)
+        self.commands.append(command)
+
+        return command
+
+    def script(self):
+        lines = []
+
+        for command in self.commands:
+            lines.append('( %s )' % command.command)
+            lines.append("rc=$?; printf '\\n%s %%s\\n' \"$rc\"" % self.marker)
+
+            if self.stop_on_error:
+                lines.append('[ "$rc" -eq 0 ] || exit 0')
+
+        return '\n'.join(lines)
+
+    def execute(self):
+        """ Run all queued commands in a single remote shell invocation
+        """
+        if not self.commands:
+            return
+
+        # Output of each command is cleaned up separately, so machine-readable output can skip it
+        output = self.vcs.remote_cmd('sh -c %s' % shell_quote(self.script()), silent=True, raw=True)
+
+        commands = iter(self.commands)
+        lines = []
+
+        for line in output.split('\n'):
+            if line.rstrip('\r').startswith(self.marker + ' '):
+                command = next(commands)
+                command.stdout = '\n'.join(lines).rstrip('\r\n')
+
+                if not command.raw:
+                    command.stdout = self.vcs.fix_output_text(command.stdout)
+
+                command.exited = int(line.rstrip('\r').split(' ', 1)[1])
+
+                lines = []
+
+            else:
+                lines.append(line)
+
+        # The batch runs silently, so show the output of commands which would have printed it when run on their own
+        for command in self.commands:
+            if not command.silent and command.stdout:
+                print(command.stdout)
+
+
+# Characters ftfy.fix_text could change: anything besides printable ascii, tabs and newlines (or html entities)
+_needs_fixing_re = re.compile(r'[^\t\n\x20-\x25\x27-\x7e]')
+
+
+# Freshness info of fetches done during this session: (host, code_dir) -> {'time': ..., 'revisions': {...}, ...}
+_fetch_registry = {}
+
+# (host, mirror path) -> time of the last mirror update during this session
+_mirror_registry = {}
+
+
 class BaseVcs(object):
     """ Core VCS api
     """
@@ -27,10 +154,19 @@ class BaseVcs(object):
     TAG = 'base'
     NAME = 'Base VCS'
 
-    def __init__(self, project_root, use_sudo=None, code_dir=None, **kwargs):
+    # Suffix of mirror repositories inside mirror_dir
+    MIRROR_SUFFIX = ''
+
+    def __init__(self, project_root, use_sudo=None, code_dir=None, fetch_ttl=0, mirror_dir=None, **kwargs):
         self.project_root = project_root
         self.use_sudo = use_sudo
 
+        # For how many seconds a completed fetch (and revisions resolved after it) can be reused, 0 disables reuse
+        self.fetch_ttl = fetch_ttl
+
+        # Directory on the target machine where a shared mirror of the repository is kept, see mirror_path
+        self.mirror_dir = mirror_dir
+
         self._context = None
         self._code_dir = None
 
@@ -120,6 +256,127 @@ class BaseVcs(object):
         """
         self._code_dir = code_dir
 
+    @property
+    def host(self):
+        if is_fabric1:
+            from fabric.api import env
+
+            return env.host_string
+
+        return getattr(self._context, 'host', None)
+
+    def _fetch_info(self):
+        key = (self.host, self.code_dir)
+
+        if key not in _fetch_registry:
+            _fetch_registry[key] = {'time': None, 'revisions': {}}
+
+        return _fetch_registry[key]
+
+    def is_fetch_fresh(self):
+        """ Check if the repository on the target machine was fetched less than `fetch_ttl` seconds ago
+
+        :rtype: bool
+        """
+        fetched_at = self._fetch_info()['time']
+
+        return bool(self.fetch_ttl) and fetched_at is not None and time.time() - fetched_at < self.fetch_ttl
+
+    def mark_fetched(self):
+        """ Remember that the repository on the target machine was just fetched (forgets resolved revisions and
+            any other info derived from the previous fetch)
+        """
+        _fetch_registry[(self.host, self.code_dir)] = {'time': time.time(), 'revisions': {}}
+
+    def invalidate_fetch(self):
+        """ Forget the last fetch of the repository on the target machine so the next pull will fetch again
+        """
+        _fetch_registry.pop((self.host, self.code_dir), None)
+
+    def get_resolved_revision(self, revision):
+        """ Get the cached resolution of `revision` if the repository is still fresh (see is_fetch_fresh)
+        """
+        if not self.is_fetch_fresh():
+            return None
+
+        return self._fetch_info()['revisions'].get(revision)
+
+    def set_resolved_revision(self, revision, resolved):
+        if self.fetch_ttl:
+            self._fetch_info()['revisions'][revision] = resolved
+
+    def forget_resolved_revisions(self):
+        """ Forget cached revision resolutions (should be called when the working copy changes)
+        """
+        info = self._fetch_info()
+        info['revisions'] = {}
+        info.pop('changesets', None)
+
+    def mirror_path(self):
+        """ Location of the mirror repository on the target machine (None if mirror_dir is not set)
+
+            Mirrors are keyed by the repo url, so all code_dirs of the same repository on a host share a mirror.
+            The mirror is fetched from origin at most once per `fetch_ttl` seconds (see update_mirror) and checkouts
+            only fetch from the mirror, so N checkouts cost one network fetch.
+
+            Git checkouts borrow objects from the mirror, so the mirror never prunes objects. Don't run
+            `git gc --prune` on it manually while checkouts created from it exist.
+
+        :rtype: str|None
+        """
+        if not self.mirror_dir:
+            return None
+
+        repo_url = self.repo_url()
+
+        if not repo_url:
+            raise EnvironmentError('%s: Repo url was not found' % self.NAME)
+
+        digest = hashlib.sha1(repo_url.encode('utf-8')).hexdigest()[:16]
+
+        return posixpath.join(self.mirror_dir, digest + self.MIRROR_SUFFIX)
+
+    def _mirror_update_cmd(self, mirror_path):
+        """ Command which creates the mirror repository or fetches it from origin if it already exists
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def is_mirror_fresh(self):
+        """ Check if the mirror repository was updated less than `fetch_ttl` seconds ago (during this session)
+
+        :rtype: bool
+        """
+        updated_at = _mirror_registry.get((self.host, self.mirror_path()))
+
+        return bool(self.fetch_ttl) and updated_at is not None and time.time() - updated_at < self.fetch_ttl
+
+    def _batch_update_mirror(self, batch, force=False):
+        """ Add mirror update to the batch unless the mirror is still fresh (see is_mirror_fresh)
+        """
+        mirror_path = self.mirror_path()
+
+        if mirror_path is None or (not force and self.is_mirror_fresh()):
+            return None
+
+        return batch.add(self._mirror_update_cmd(mirror_path))
+
+    def _batch_update_mirror_result(self, command):
+        if command is not None:
+            command.result()
+            _mirror_registry[(self.host, self.mirror_path())] = time.time()
+
+    def update_mirror(self, force=False):
+        """ Create or update the mirror repository on the target machine (no-op if mirror_dir is not set)
+
+        :param force: Fetch even if the mirror is still fresh (see is_mirror_fresh)
+        """
+        batch = self.batch()
+        command = self._batch_update_mirror(batch, force=force)
+
+        if command is not None:
+            batch.execute()
+            self._batch_update_mirror_result(command)
+
     def run(self, command, **kwargs):
         if self.cmd_cwd:
             with self.real_cd(self.cmd_cwd):
@@ -156,7 +413,7 @@ class BaseVcs(object):
                 # Once the issue is resolved in upstream we can make self.cd use builtin c.cd again and remove self.cmd_cwd
                 #  and SudoCWDContext class
                 if self.cmd_cwd:
-                    w_command = 'bash -c "cd ' + self.cmd_cwd + ' && ' + w_command + '"'
+                    w_command = 'bash -c %s' % shell_quote('cd %s && %s' % (shell_quote(self.cmd_cwd), w_command))
 
                 res = self.context.sudo(w_command, **w_kwargs)
 
@@ -193,6 +450,9 @@ class BaseVcs(object):
     def clone(self, revision=None):
         """ Clones the project to a target machine. Will abort if something goes wrong.
 
+            Implementations accept extra keyword arguments for faster clones of large repositories, see
+            Git.clone (depth, filter_spec, single_branch, reference) and Mercurial.clone (uncompressed, share_from).
+
         :param revision: Can be used to specify a branch or commit that should be activated after cloning.
         """
         raise NotImplementedError  # pragma: no cover
@@ -205,9 +465,14 @@ class BaseVcs(object):
         """
         raise NotImplementedError  # pragma: no cover
 
-    def pull(self):
+    def pull(self, force=False):
         """ Update the cloned repository on the target machine without changing
             the working copy. Internally this is done via `git fetch` or `hg pull`.
+
+            If the repository was already fetched less than `fetch_ttl` seconds ago (during this session) the
+            fetch is skipped, unless `force` is set.
+
+        :param force: Fetch even if the repository is still fresh
         """
         raise NotImplementedError  # pragma: no cover
 
@@ -252,6 +517,14 @@ class BaseVcs(object):
 
         raise NotImplementedError  # pragma: no cover
 
+    def batch(self, stop_on_error=True):
+        """ Create a queue of commands to run in a single remote shell invocation, see RemoteBatch
+
+        :param stop_on_error: Do not run the remaining commands after one of them fails
+        :rtype: RemoteBatch
+        """
+        return RemoteBatch(self, stop_on_error=stop_on_error)
+
     def remote_cmd(self, command, **kwargs):
         silent = kwargs.pop('silent', False)
 
@@ -272,53 +545,103 @@ class BaseVcs(object):
             return self._remote_cmd(command, **kwargs)
 
     @classmethod
-    def cleanup_command_result(cls, result):
-        str_result = ftfy.guess_bytes(result)[0] if is_fabric1 else result
+    def cleanup_command_result(cls, result, raw=False):
+        """ Decode command output and fix mojibake in it
+
+            Use raw for machine-readable output (hashes, refs, paths) which doesn't need fixing.
+
+        :param raw: Only decode the output, keeping it exactly as returned by the command (e.g. NUL separators
+                    of `-z` output which fix_text would remove)
+        """
+        if is_fabric1:
+            try:
+                # Fast path for plain ascii output
+                result = result.decode('ascii')
+
+            except (AttributeError, UnicodeError):
+                import ftfy
+
+                result = ftfy.guess_bytes(result)[0]
+
+        if raw:
+            return result
+
+        return cls.fix_output_text(result)
+
+    @classmethod
+    def fix_output_text(cls, text):
+        """ Fix mojibake etc in (decoded) command output, skipped for text which ftfy would not change anyway
+        """
+        if not _needs_fixing_re.search(text):
+            return text
+
+        # Imported on first use since importing ftfy is slow
+        import ftfy
 
-        return ftfy.fix_text(str_result)
+        return ftfy.fix_text(text)
 
     def _remote_cmd(self, command, **kwargs):
+        raw = kwargs.pop('raw', False)
+
         if self.use_sudo:
-            return self.cleanup_command_result(self.sudo(command, **kwargs))
+            return self.cleanup_command_result(self.sudo(command, **kwargs), raw=raw)
 
         else:  # pragma: no cover
-            return self.cleanup_command_result(self.run(command, **kwargs))
+            return self.cleanup_command_result(self.run(command, **kwargs), raw=raw)
 
     def _changed_files(self, revision_set):
+        """ Iterate over the changed files entries of the given revset (unfiltered)
+        """
         raise NotImplementedError  # pragma: no cover
 
-    def changed_files(self, revision_set, filter_re=None):
-        """ Returns list of files that changed in the given revset, optionally filtered by the given regex or list of regex values.
+    def _changed_file_records(self, revision_set):
+        """ Iterate over the changes of the given revset as FileChange records
+        """
+        raise NotImplementedError  # pragma: no cover
 
-            Each returned item is a combination of the action and the file name separated by space:
-            > ['A test.tx', 'M foo.bar', 'R hello_world']
+    def get_changeset(self, revision_set):
+        """ Get an index of the files that changed in the given revset (see ChangeSet)
+
+            The diff is run once per revset, later calls return the same ChangeSet until the repository is fetched
+            again or the working copy is updated.
 
         :param revision_set: Revision set to use when building changed file list
-        :param filter_re: optional regex filter (or list of regex values)
-        :return: files changed
-        :rtype: list
+        :rtype: ChangeSet
         """
-        result = self._changed_files(revision_set)
+        changesets = self._fetch_info().setdefault('changesets', {})
 
-        if filter_re:
-            def finder(pattern):
-                regex = re.compile(pattern)
+        if revision_set not in changesets:
+            changesets[revision_set] = ChangeSet(self._changed_file_records(revision_set))
 
-                return list(filter(lambda filename: regex.search(filename), result))
+        return changesets[revision_set]
 
-            if isinstance(filter_re, (list, tuple)):
-                full_result = []
+    def iter_changed_files(self, revision_set, filter_re=None):
+        """ Same as changed_files but returns a generator, entries are parsed and filtered lazily.
 
-                for reg in filter_re:
-                    for res in finder(reg):
-                        full_result.append(res)
+            All patterns of filter_re are compiled once into a single (cached) matcher, so each entry is checked
+            only once and is yielded at most once, in the order returned by the vcs.
 
-                result = full_result
+        :param revision_set: Revision set to use when building changed file list
+        :param filter_re: optional regex filter (or list of regex values), `glob:` prefixed values are matched as
+                          shell-style patterns against the file name, e.g. `glob:*.py`
+        :rtype: generator
+        """
+        return filter_changes(self._changed_files(revision_set), filter_re)
 
-            else:
-                result = finder(filter_re)
+    def changed_files(self, revision_set, filter_re=None):
+        """ Returns list of files that changed in the given revset, optionally filtered by the given regex or list of regex values.
 
-        return result
+            Each returned item is a combination of the action and the file name separated by space:
+            > ['A test.tx', 'M foo.bar', 'R hello_world']
+
+            Items matching several patterns of filter_re are only returned once, see iter_changed_files.
+
+        :param revision_set: Revision set to use when building changed file list
+        :param filter_re: optional regex filter (or list of regex values)
+        :return: files changed
+        :rtype: list
+        """
+        return list(self.iter_changed_files(revision_set, filter_re))
 
     @classmethod
     def get_revset(cls, x, y):
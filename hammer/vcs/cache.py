@@ -0,0 +1,176 @@
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'tg-hammer')
+
+
+class BranchCache(object):
+    """ Persistent (on-disk) commit -> branch cache which can be shared across Git instances and deploy runs.
+
+        Entries are keyed by the repository url and the full commit hash. When the cache grows over `max_entries`
+        the least recently used entries are evicted. The tip of each cached branch is remembered as well, entries
+        of a branch are only dropped once the branch is deleted or rewritten (see validate), so pushes to a
+        branch (or to other branches) keep the cache warm.
+
+        Usage:
+
+        >>> vcs = Vcs.init(project_root=..., use_sudo=True, persistent_branch_cache=BranchCache())
+
+    :param path: Location of the cache file (defaults to `$XDG_CACHE_HOME/tg-hammer/branches.json`)
+    :param max_entries: Maximum number of commits to remember
+    """
+
+    def __init__(self, path=None, max_entries=10000):
+        self.path = path or os.path.join(default_cache_dir(), 'branches.json')
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._tips = {}
+        self._loaded_mtime = None
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+
+        except OSError:
+            return None
+
+    def _load(self):
+        """ (Re)load the cache file if it was changed since it was last read
+        """
+        mtime = self._file_mtime()
+
+        if mtime is None or mtime == self._loaded_mtime:
+            return
+
+        try:
+            with open(self.path, 'r') as handle:
+                data = json.load(handle)
+
+        except (IOError, OSError, ValueError):
+            # Treat unreadable/corrupt cache files as empty
+            data = {}
+
+        self._entries = OrderedDict(((repo_url, commit_id), branch) for repo_url, commit_id, branch in data.get('entries', []))
+        self._tips = data.get('tips', {})
+        self._loaded_mtime = mtime
+
+    def _save(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        directory = os.path.dirname(self.path)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        data = {
+            'tips': self._tips,
+            'entries': [[repo_url, commit_id, branch] for (repo_url, commit_id), branch in self._entries.items()],
+        }
+
+        # Write to a temporary file first so concurrent readers never see a partially written cache
+        handle, tmp_path = tempfile.mkstemp(dir=directory or None, prefix='.branches')
+
+        with os.fdopen(handle, 'w') as handle:
+            json.dump(data, handle)
+
+        os.rename(tmp_path, self.path)
+
+        self._loaded_mtime = self._file_mtime()
+
+    def validate(self, repo_url, tips, is_fast_forward=None):
+        """ Drop entries of branches which were deleted or rewritten since the last call
+
+            A branch whose tip moved is still valid if its old tip is an ancestor of the new one (commits
+            which were on the branch still are).
+
+        :param repo_url: Url of the repository
+        :param tips: Mapping of branch name -> current tip commit of all branches of the repository
+        :param is_fast_forward: Function which takes a mapping of branch name -> (old tip, new tip) and returns the
+                                branches whose old tip is an ancestor of the new one. Without it moved branches
+                                are treated as rewritten.
+        """
+        self._load()
+
+        known = self._tips.get(repo_url, {})
+        moved = dict((branch, (tip, tips[branch])) for branch, tip in known.items() if tips.get(branch, tip) != tip)
+        fast_forwarded = set(is_fast_forward(moved)) if moved and is_fast_forward is not None else set()
+
+        stale = []
+        cached_tips = {}
+
+        for key, branch in self._entries.items():
+            if key[0] != repo_url:
+                continue
+
+            if branch not in tips or (branch in moved and branch not in fast_forwarded):
+                stale.append(key)
+
+            else:
+                cached_tips[branch] = tips[branch]
+
+        if not stale and cached_tips == known:
+            return
+
+        for key in stale:
+            del self._entries[key]
+
+        self._tips[repo_url] = cached_tips
+        self._save()
+
+    def get(self, repo_url, commit_id):
+        """ Get the cached branch of a commit
+
+        :return: branch name or None if the commit is not cached
+        :rtype: str|None
+        """
+        self._load()
+
+        branch = self._entries.pop((repo_url, commit_id), None)
+
+        if branch is not None:
+            # Mark the entry as most recently used
+            self._entries[(repo_url, commit_id)] = branch
+
+        return branch
+
+    def update(self, repo_url, branches, tips=None):
+        """ Store the branches of several commits
+
+        :param repo_url: Url of the repository
+        :param branches: Mapping of full commit hash -> branch name
+        :param tips: Mapping of branch name -> current tip commit (used by validate to detect rewritten branches)
+        """
+        if not branches:
+            return
+
+        self._load()
+
+        repo_tips = self._tips.setdefault(repo_url, {})
+
+        for commit_id, branch in branches.items():
+            self._entries.pop((repo_url, commit_id), None)
+            self._entries[(repo_url, commit_id)] = branch
+
+            if tips and branch in tips:
+                repo_tips.setdefault(branch, tips[branch])
+
+        self._save()
+
+    def set(self, repo_url, commit_id, branch, tips=None):
+        self.update(repo_url, {commit_id: branch}, tips=tips)
+
+    def clear(self):
+        self._entries = OrderedDict()
+        self._tips = {}
+        self._save()
+
+    def __len__(self):
+        self._load()
+
+        return len(self._entries)
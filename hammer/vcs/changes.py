@@ -0,0 +1,309 @@
+""" Helpers for filtering and indexing changed file lists (see BaseVcs.changed_files and BaseVcs.get_changeset)
+
+    Filters are a regex or a list of regex values which are matched against the whole entry (e.g. `M foo/bar.py`).
+    Values prefixed with `glob:` are shell-style patterns matched against the file name only (e.g. `glob:*.py`).
+    All patterns of a filter are compiled once into a single matcher which is cached for later calls.
+"""
+import fnmatch
+import posixpath
+import re
+from collections import namedtuple
+
+
+# filter (as a tuple of patterns) -> matcher
+_matcher_cache = {}
+
+GLOB_PREFIX = 'glob:'
+
+
+def iter_lines(text):
+    """ Iterate over non-empty lines of text without building a list of all of them
+    """
+    start = 0
+    length = len(text)
+
+    while start < length:
+        end = text.find('\n', start)
+
+        if end == -1:
+            end = length
+
+        line = text[start:end].rstrip('\r')
+        start = end + 1
+
+        if line:
+            yield line
+
+
+def entry_filename(entry):
+    """ Get the file name of a changed files entry (`A foo.txt` -> `foo.txt`)
+    """
+    return entry.split(' ', 1)[-1]
+
+
+def _is_string(value):
+    return isinstance(value, (type(''), type(b''), type(u'')))
+
+
+def _combine(patterns):
+    if not patterns:
+        return None
+
+    try:
+        return re.compile('|'.join('(?:%s)' % x for x in patterns)).search
+
+    except re.error:
+        # Patterns which can't be combined (e.g. conflicting group names) are matched one-by-one
+        compiled = [re.compile(x) for x in patterns]
+
+        return lambda value: any(x.search(value) for x in compiled)
+
+
+def compile_filter(filter_re):
+    """ Compile a filter (regex, `glob:` pattern or a list of them) into a single matcher
+
+    :param filter_re: regex filter (or list of regex values), strings or compiled regex objects
+    :return: Function which takes a changed files entry and returns True if it matches, None if the filter is empty
+    """
+    if not filter_re:
+        return None
+
+    patterns = tuple(filter_re) if isinstance(filter_re, (list, tuple)) else (filter_re, )
+
+    if patterns not in _matcher_cache:
+        strings = [x for x in patterns if _is_string(x)]
+
+        regex = _combine([x for x in strings if not x.startswith(GLOB_PREFIX)])
+        glob = _combine([fnmatch.translate(x[len(GLOB_PREFIX):]) for x in strings if x.startswith(GLOB_PREFIX)])
+
+        # Already compiled patterns keep their own flags, so they are matched one-by-one
+        compiled = [x.search for x in patterns if not _is_string(x)]
+
+        def matcher(entry):
+            if regex is not None and regex(entry):
+                return True
+
+            if any(search(entry) for search in compiled):
+                return True
+
+            return glob is not None and bool(glob(entry_filename(entry)))
+
+        _matcher_cache[patterns] = matcher
+
+    return _matcher_cache[patterns]
+
+
+def filter_changes(entries, filter_re=None):
+    """ Lazily filter changed files entries, each entry is yielded once (in the original order)
+
+    :param entries: Iterable of changed files entries
+    :param filter_re: optional regex filter (or list of regex values)
+    """
+    matcher = compile_filter(filter_re)
+    seen = set()
+
+    for entry in entries:
+        if entry in seen or (matcher is not None and not matcher(entry)):
+            continue
+
+        seen.add(entry)
+
+        yield entry
+
+
+class FileChange(namedtuple('FileChange', ['action', 'path', 'old_path', 'similarity'])):
+    """ A single changed file
+
+        - action:       A (added), M (modified), D (deleted), R (renamed) or C (copied)
+        - path:         Path of the file (the new path for renames and copies)
+        - old_path:     Original path for renames and copies, None otherwise
+        - similarity:   Similarity percentage for renames and copies (when known), None otherwise
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, action, path, old_path=None, similarity=None):
+        return super(FileChange, cls).__new__(cls, action, path, old_path, similarity)
+
+    @property
+    def entry(self):
+        """ Same format as returned by changed_files, e.g. `M foo.txt` (renames and copies, which changed_files
+            reports as deleted and added files, are `R100 old.txt new.txt`)
+        """
+        action = '%s%03d' % (self.action, self.similarity) if self.similarity is not None else self.action
+
+        if self.old_path is not None:
+            return '%s %s %s' % (action, self.old_path, self.path)
+
+        return '%s %s' % (action, self.path)
+
+    @property
+    def paths(self):
+        """ Paths touched by the change (both the old and new path for renames/copies)
+        """
+        if self.old_path is not None:
+            return self.old_path, self.path
+
+        return self.path,
+
+
+def _normalize_directory(directory):
+    return directory.strip('/')
+
+
+def _normalize_extension(extension):
+    extension = extension.lower()
+
+    return extension if extension.startswith('.') else '.' + extension
+
+
+class ChangeSet(object):
+    """ Index of files changed in a revision set, built from a single diff
+
+        Changes are indexed by action, by every parent directory and by extension, so repeated questions like
+        "did any migrations change?" don't need extra remote commands:
+
+        >>> changes = vcs.get_changeset(result['revset'])
+        >>> changes.any(directory='app/migrations', extensions=['.py'])
+        >>> changes.with_action('D')
+        >>> 'requirements.txt' in changes
+
+        Renames and copies are indexed under both the old and the new path.
+
+    :param changes: Iterable of FileChange
+    """
+
+    def __init__(self, changes):
+        self.changes = []
+
+        self._by_path = {}
+        self._by_action = {}
+        self._by_directory = {}
+        self._by_extension = {}
+
+        for change in changes:
+            self._add(change)
+
+    def _add(self, change):
+        index = len(self.changes)
+        self.changes.append(change)
+
+        self._by_action.setdefault(change.action, []).append(index)
+
+        directories = set()
+        extensions = set()
+
+        for path in change.paths:
+            self._by_path[path] = index
+
+            directory = posixpath.dirname(path)
+
+            while directory and directory not in directories:
+                directories.add(directory)
+                directory = posixpath.dirname(directory)
+
+            extension = posixpath.splitext(path)[1]
+
+            if extension:
+                extensions.add(extension.lower())
+
+        for directory in directories:
+            self._by_directory.setdefault(directory, []).append(index)
+
+        for extension in extensions:
+            self._by_extension.setdefault(extension, []).append(index)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, path):
+        return path in self._by_path
+
+    def get(self, path):
+        """ Get the change of a file (by its old or new path)
+
+        :rtype: FileChange|None
+        """
+        index = self._by_path.get(path)
+
+        return self.changes[index] if index is not None else None
+
+    @property
+    def paths(self):
+        return [change.path for change in self.changes]
+
+    @property
+    def entries(self):
+        """ Changes in the changed_files format
+        """
+        return [change.entry for change in self.changes]
+
+    def _indexes(self, directory=None, extensions=None, actions=None):
+        candidates = []
+
+        if directory:
+            candidates.append(self._by_directory.get(_normalize_directory(directory), []))
+
+        if extensions:
+            if not isinstance(extensions, (list, tuple, set)):
+                extensions = [extensions]
+
+            candidates.append(sorted(set(i for x in extensions for i in self._by_extension.get(_normalize_extension(x), []))))
+
+        if actions:
+            candidates.append(sorted(set(i for x in actions for i in self._by_action.get(x, []))))
+
+        if not candidates:
+            return list(range(len(self.changes)))
+
+        # Start from the smallest candidate list and check the others via sets
+        candidates.sort(key=len)
+        others = [set(x) for x in candidates[1:]]
+
+        return [i for i in candidates[0] if all(i in x for x in others)]
+
+    def select(self, directory=None, extensions=None, actions=None):
+        """ Get changes matching all the given criteria
+
+        :param directory: Only changes inside this directory (at any depth)
+        :param extensions: Only changes of files with these extensions (e.g. `.py` or `['.js', '.css']`)
+        :param actions: Only changes with these actions (e.g. `['A', 'M']`)
+        :rtype: list
+        """
+        return [self.changes[i] for i in self._indexes(directory, extensions, actions)]
+
+    def any(self, directory=None, extensions=None, actions=None):
+        """ Check if any change matches all the given criteria (see select)
+
+        :rtype: bool
+        """
+        return bool(self._indexes(directory, extensions, actions))
+
+    def with_action(self, *actions):
+        return self.select(actions=actions)
+
+    def with_extension(self, *extensions):
+        return self.select(extensions=list(extensions))
+
+    def in_directory(self, directory):
+        return self.select(directory=directory)
+
+    def filter(self, filter_re):
+        """ Get changes whose changed_files entry matches the filter (see compile_filter)
+
+        :rtype: list
+        """
+        matcher = compile_filter(filter_re)
+
+        if matcher is None:
+            return list(self.changes)
+
+        return [change for change in self.changes if matcher(change.entry)]
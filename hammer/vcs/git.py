@@ -1,11 +1,15 @@
 import os
+import posixpath
 import sys
-from subprocess import check_output, CalledProcessError
+from collections import OrderedDict
 
 from hammer.colors import green, red, yellow
-from hammer.util import abort, prompt, as_str, UnexpectedExit
+from hammer.util import abort, prompt, as_str, shell_quote, UnexpectedExit
 
 from .base import BaseVcs
+from .cache import BranchCache
+from .changes import FileChange
+from .local import git_remotes
 
 
 def ask_input(*args):
@@ -20,23 +24,53 @@ class Git(BaseVcs):
     TAG = 'git'
     NAME = 'Git'
 
-    def __init__(self, project_root, use_sudo=None, code_dir=None, **kwargs):
+    MIRROR_SUFFIX = '.git'
+
+    # Maximum number of commits resolved by a single remote command in resolve_branches
+    BRANCH_RESOLVE_CHUNK_SIZE = 200
+
+    # Lists whether the target repository is shallow, the origin url and all local and remote-tracking refs
+    REFS_SNAPSHOT_CMD = ("git rev-parse --is-shallow-repository && git ls-remote --get-url origin && "
+                         "echo $(git config --get-all remote.origin.fetch) && "
+                         "git for-each-ref --format='%(objectname) %(refname)' refs/heads/ refs/remotes/")
+
+    # How many commits to deepen shallow clones by at first (doubled on each attempt) and the number of attempts
+    #  before giving up and fetching the whole history
+    DEEPEN_STEP = 50
+    DEEPEN_ATTEMPTS = 4
+
+    def __init__(self, project_root, use_sudo=None, code_dir=None, persistent_branch_cache=None, ls_remote=False, **kwargs):
         self._branch_cache = {}
+        self._branch_candidates = {}
+        self._full_commit_ids = {}
+
+        # Optional on-disk cache shared across instances (pass True to use the default location)
+        if persistent_branch_cache is True:
+            persistent_branch_cache = BranchCache()
+
+        self.persistent_branch_cache = persistent_branch_cache
+        self._persistent_cache_info = None
+
+        self._selected_remote = None
+
+        # Check branch existence via `git ls-remote` instead of the refs fetched by the last pull
+        self.ls_remote = ls_remote
 
         super(Git, self).__init__(project_root, use_sudo, code_dir, **kwargs)
 
     def repo_url(self):
         """Get remote url of the current repository"""
 
-        # Get all remotes
-        remotes = as_str(check_output(['sh', '-c', "git remote -v | awk '{split($0, a); print a[1]}' | awk '!seen[$0]++'"],
-                                      cwd=self.project_root)).rstrip('\n').splitlines()
+        # Get all remotes (read from the local git config, memoized)
+        remotes = OrderedDict(git_remotes(self.project_root))
 
         if not remotes:
             return None
 
         if len(remotes) > 1:
-            remotes = dict([(remote_name, self._get_remote_url(remote_name)) for remote_name in remotes])
+            # Remember the selection so the user is not asked again (unless the remotes change)
+            if self._selected_remote is not None and self._selected_remote[0] == remotes:
+                return self._selected_remote[1]
 
             valid_choices = ['abort', ] + list(remotes.keys())
 
@@ -58,34 +92,77 @@ class Git(BaseVcs):
             if selected == 'abort':
                 abort('Aborted by user')
 
-            return as_str(remotes[selected])
+            self._selected_remote = (remotes, as_str(remotes[selected]))
 
-        else:
-            return as_str(self._get_remote_url(remotes[0])) or None
+            return self._selected_remote[1]
 
-    def _get_remote_url(self, remote_name):
-        try:
-            result = as_str(check_output(['sh', '-c', 'git config --get remote.%s.url' % remote_name], cwd=self.project_root)).rstrip('\n')
+        else:
+            return as_str(list(remotes.values())[0]) or None
 
-        except CalledProcessError as e:
-            if e.returncode == 1:
-                result = None
+    def clone(self, revision=None, depth=None, filter_spec=None, single_branch=False, reference=None):
+        """ Clones the project to a target machine. Will abort if something goes wrong.
 
-            else:
-                raise  # pragma: no cover
+            Shallow clones are deepened automatically when update/deployment_list needs commits that are missing.
 
-        return result or None
+        :param revision: Can be used to specify a branch or commit that should be activated after cloning.
+        :param depth: Create a shallow clone with history truncated to the given number of commits (--depth)
+        :param filter_spec: Create a partial clone, e.g. `blob:none` (--filter)
+        :param single_branch: Only clone history of the default (or `revision`) branch (--single-branch)
+        :param reference: Path to a local repository (mirror) on the target machine to borrow objects from (--reference)
 
-    def clone(self, revision=None):
+            If mirror_dir is set the mirror is updated and the project is cloned from it (using it as reference), so
+            no objects are transferred over the network unless the mirror is behind origin.
+        """
         repo_url = self.repo_url()
 
         if not repo_url:
             abort('Repo url was not found')  # pragma: no cover
 
-        self.remote_cmd('git clone %(repo)s %(dir)s' % dict(
-            repo=repo_url,
+        options = []
+
+        if depth:
+            options.append('--depth %d' % int(depth))
+
+            # --depth implies --single-branch, but we still want to be able to deploy other branches
+            if not single_branch:
+                options.append('--no-single-branch')
+
+        if filter_spec:
+            options.append('--filter=%s' % shell_quote(filter_spec))
+
+        if single_branch:
+            options.append('--single-branch')
+
+            if self._is_branch_name(revision):
+                options.append('--branch %s' % shell_quote(revision))
+
+        mirror_path = self.mirror_path()
+
+        if reference or mirror_path:
+            options.append('--reference %s' % shell_quote(reference or mirror_path))
+
+        batch = self.batch()
+        mirror = self._batch_update_mirror(batch)
+
+        batch.add('git clone %(options)s%(repo)s %(dir)s' % dict(
+            options=''.join(['%s ' % x for x in options]),
+            repo=shell_quote(mirror_path) if mirror_path else repo_url,
             dir=self.code_dir,
-        ))
+        ), silent=False)
+
+        if mirror_path:
+            batch.add('git --git-dir=%s remote set-url origin %s' % (
+                shell_quote(posixpath.join(self.code_dir, '.git')), shell_quote(repo_url),
+            ))
+
+        batch.execute()
+
+        self._batch_update_mirror_result(mirror)
+
+        for command in batch.commands:
+            command.result()
+
+        self.mark_fetched()
 
         # update to a specific version
         if revision:
@@ -103,21 +180,47 @@ class Git(BaseVcs):
 
         return commit_id, branch, message, author
 
+    @staticmethod
+    def _cleanup_branch_name(branch_name):
+        branch_name = branch_name.strip()
+
+        if branch_name.startswith('['):
+            return None
+
+        if branch_name.startswith('* '):
+            branch_name = branch_name[2:]
+
+        if not Git._can_normalize_branch(branch_name):
+            return None
+
+        if 'HEAD' in branch_name:
+            return None
+
+        for prefix in ['refs/remotes/origin/', 'refs/remotes/', 'refs/heads/', 'remotes/origin/', 'origin/']:
+            if branch_name.startswith(prefix):
+                branch_name = branch_name[len(prefix):]
+
+        return branch_name
+
     def _get_commit_branch(self, commit_id):
+        # Use the candidates found by resolve_branches, if possible.
+        if commit_id in self._branch_candidates:
+            return list(self._branch_candidates[commit_id]), commit_id
+
         candidates = []
 
         # Attempt to figure out the branch/branches via git branch --contains
         try:
             candidates = self.remote_cmd(
                 'git for-each-ref --contains %s --format \'%%(refname)\' refs/remotes/' % commit_id,
-                silent=True,
+                silent=True, raw=True,
             ).strip().splitlines(False)
         except UnexpectedExit:
             # Fall back to older way of determining the branch
             try:
                 candidates = self.remote_cmd(
                     'git branch --color=never -a --contains %s' % commit_id,
-                    silent=True,
+                    silent=True, raw=True,
                 ).strip().splitlines(False)
             except UnexpectedExit as e:
                 # Previous command will exit with code 129 if the commit_id is invalid.
@@ -126,28 +229,7 @@ class Git(BaseVcs):
                     raise  # pragma: no cover
 
         # cleanup candidates
-        def cleanup_branch_name(_branch_name):
-            _branch_name = _branch_name.strip()
-
-            if _branch_name.startswith('['):
-                return None
-
-            if _branch_name.startswith('* '):
-                _branch_name = _branch_name[2:]
-
-            if not Git._can_normalize_branch(_branch_name):
-                return None
-
-            if 'HEAD' in _branch_name:
-                return None
-
-            for prefix in ['refs/remotes/origin/', 'refs/remotes/', 'remotes/origin/', 'origin/']:
-                if _branch_name.startswith(prefix):
-                    _branch_name = _branch_name[len(prefix):]
-
-            return _branch_name
-
-        candidates = list(filter(lambda _b: _b, set(map(cleanup_branch_name, candidates))))
+        candidates = list(filter(lambda _b: _b, set(map(self._cleanup_branch_name, candidates))))
 
         # If there are still some candidates after cleanup return them
         if candidates:
@@ -157,7 +239,7 @@ class Git(BaseVcs):
 
         # Attempt to figure out the branch via git symbolic-ref
         try:
-            branch = self.remote_cmd('git symbolic-ref --short -q %s' % commit_id, silent=True)
+            branch = self.remote_cmd('git symbolic-ref --short -q %s' % commit_id, silent=True, raw=True)
 
             # Let's return the branch if we found one
             if branch:
@@ -201,6 +283,171 @@ class Git(BaseVcs):
         valid_branches, real_commit = self.git_what_branch(commit_id, remote=True)
         return valid_branches, real_commit
 
+    def _full_commit_id(self, commit_id, resolve=True):
+        if commit_id not in self._full_commit_ids:
+            if not resolve:
+                return None
+
+            with self.cd(self.code_dir):
+                try:
+                    self._full_commit_ids[commit_id] = self.remote_cmd(
+                        'git rev-parse --verify -q %s' % shell_quote('%s^{commit}' % commit_id),
+                        silent=True, raw=True,
+                    ).strip() or None
+
+                except UnexpectedExit:
+                    self._full_commit_ids[commit_id] = None
+
+        return self._full_commit_ids[commit_id]
+
+    def _persistent_cache_repo(self):
+        """ Get the repository url and remote branch tips used for the persistent branch cache
+
+            The first call after each pull also validates the persistent cache against the current remote refs,
+            only entries of deleted or rewritten branches are dropped.
+
+        :return: (repo_url, {branch: tip commit})
+        """
+        snapshot = self.get_refs_snapshot()
+
+        if self._persistent_cache_info is None or self._persistent_cache_info[0] is not snapshot:
+            repo_url, refs = snapshot
+            tips = {}
+
+            for ref, commit_id in refs.items():
+                branch = self._cleanup_branch_name(ref) if ref.startswith('refs/remotes/') else None
+
+                if branch:
+                    tips[branch] = commit_id
+
+            self.persistent_branch_cache.validate(repo_url, tips, is_fast_forward=self._fast_forwarded_branches)
+            self._persistent_cache_info = (snapshot, repo_url, tips)
+
+        return self._persistent_cache_info[1:]
+
+    def _persistent_cache_repo_url(self):
+        return self._persistent_cache_repo()[0]
+
+    def _fast_forwarded_branches(self, moved):
+        """ Check (in a single remote command) which moved branches still contain their old tip
+
+        :param moved: Mapping of branch name -> (old tip, new tip)
+        :rtype: set
+        """
+        with self.cd(self.code_dir):
+            result = self.remote_cmd('; '.join([
+                'git merge-base --is-ancestor %s %s 2>/dev/null && echo %s' % (old, new, shell_quote(branch))
+                for branch, (old, new) in sorted(moved.items())
+            ] + ['true']), silent=True, raw=True)
+
+        return set(line.strip() for line in result.splitlines() if line.strip())
+
+    def _get_cached_branch(self, commit_id, resolve=True):
+        """ Get the branch of a commit from the branch cache or the persistent branch cache (if enabled)
+
+        :param resolve: Set to False to skip the persistent cache if the full hash of the commit is not known yet
+        :return: branch name or None if commit is not cached
+        """
+        if not commit_id:
+            return None
+
+        if commit_id in self._branch_cache:
+            return self._branch_cache[commit_id]
+
+        if self.persistent_branch_cache is None:
+            return None
+
+        full_commit_id = self._full_commit_id(commit_id, resolve=resolve)
+
+        if not full_commit_id:
+            return None
+
+        branch = self.persistent_branch_cache.get(self._persistent_cache_repo_url(), full_commit_id)
+
+        if branch is not None:
+            self._branch_cache[commit_id] = branch
+
+        return branch
+
+    def _cache_branches(self, branches):
+        """ Store commit -> branch mapping in the branch cache and the persistent branch cache (if enabled)
+        """
+        self._branch_cache.update(branches)
+
+        if self.persistent_branch_cache is not None and branches:
+            full_branches = {}
+
+            for commit_id, branch in branches.items():
+                full_commit_id = self._full_commit_id(commit_id)
+
+                if full_commit_id:
+                    full_branches[full_commit_id] = branch
+
+            repo_url, tips = self._persistent_cache_repo()
+            self.persistent_branch_cache.update(repo_url, full_branches, tips=tips)
+
+    def resolve_branches(self, commit_ids):
+        """ Figure out the remote branches of several commits at once.
+
+            Instead of doing the lookup commit-by-commit (which can take several round-trips per commit) this
+            maps every commit to its containing remote refs via `git for-each-ref --contains` in a single remote
+            command (per BRANCH_RESOLVE_CHUNK_SIZE commits). Commits which belong to a single branch are stored in
+            the branch cache, ambiguous ones are remembered so get_branch does not have to look them up again.
+
+            Commits which could not be resolved are left for get_branch to figure out the slow way.
+
+        :param commit_ids: Commit hashes to resolve
+        """
+        pending = []
+
+        for commit_id in commit_ids:
+            if not commit_id or commit_id in pending:
+                continue
+
+            if commit_id in self._branch_candidates or self._get_cached_branch(commit_id, resolve=False) is not None:
+                continue
+
+            pending.append(commit_id)
+
+        with self.cd(self.code_dir):
+            for offset in range(0, len(pending), self.BRANCH_RESOLVE_CHUNK_SIZE):
+                chunk = pending[offset:offset + self.BRANCH_RESOLVE_CHUNK_SIZE]
+
+                try:
+                    result = self.remote_cmd(' && '.join([
+                        "git for-each-ref --contains {0} --format='{0} %(refname)' refs/remotes/".format(commit_id)
+                        for commit_id in chunk
+                    ]), silent=True, raw=True)
+
+                except UnexpectedExit:
+                    # Older versions of git don't support `for-each-ref --contains`, get_branch will use
+                    #  its fallbacks instead
+                    return
+
+                candidates = dict([(commit_id, set()) for commit_id in chunk])
+
+                for line in result.strip().splitlines(False):
+                    parts = line.strip().split(' ', 1)
+
+                    if len(parts) != 2 or parts[0] not in candidates:
+                        continue  # pragma: no cover
+
+                    branch = self._cleanup_branch_name(parts[1])
+
+                    if branch:
+                        candidates[parts[0]].add(branch)
+
+                resolved = {}
+
+                for commit_id, branches in candidates.items():
+                    if len(branches) == 1:
+                        resolved[commit_id] = list(branches)[0]
+
+                    elif branches:
+                        self._branch_candidates[commit_id] = sorted(branches)
+
+                self._cache_branches(resolved)
+
     def get_branch(self, commit_id='HEAD', ambiguous=False):
         with self.cd(self.code_dir):
 
@@ -209,8 +456,10 @@ class Git(BaseVcs):
                 commit_id = self.get_commit_id()
 
             # Use the branch cache, if possible.
-            if commit_id and commit_id in self._branch_cache:
-                return self._branch_cache[commit_id]
+            cached_branch = self._get_cached_branch(commit_id)
+
+            if cached_branch is not None:
+                return cached_branch
 
             valid_branches, real_commit = self._get_commit_branch(commit_id)
 
@@ -245,21 +494,168 @@ class Git(BaseVcs):
 
                 else:
                     if real_commit:
-                        self._branch_cache[real_commit] = valid_branches[value - 1]
+                        self._cache_branches({real_commit: valid_branches[value - 1]})
 
                     return valid_branches[value - 1]
 
             else:
                 if real_commit:
-                    self._branch_cache[real_commit] = valid_branches[0]
+                    self._cache_branches({real_commit: valid_branches[0]})
 
                 return valid_branches[0]
 
-    def pull(self):
+    def pull(self, force=False):
         with self.cd(self.code_dir):
-            self.remote_cmd('git fetch origin')
+            batch = self.batch()
+            fetch = self._batch_fetch(batch, force=force)
+            batch.execute()
+
+            self._batch_fetch_result(fetch)
+
+    # Checkouts borrow objects from the mirror (clone --reference), so the mirror must never prune objects even if
+    #  the branches referencing them are deleted or force-pushed (the checkouts would be corrupted otherwise)
+    MIRROR_CONFIG = '-c gc.auto=0 -c gc.pruneExpire=never'
+
+    def _mirror_update_cmd(self, mirror_path):
+        # The config is also given to fetch, so mirrors created by older versions are safe as well
+        return 'if [ -d %(path)s ]; then git %(config)s --git-dir=%(path)s fetch --prune --quiet origin; ' \
+               'else mkdir -p %(dir)s && git clone %(config)s --mirror --quiet %(repo)s %(path)s; fi' % dict(
+                   path=shell_quote(mirror_path),
+                   dir=shell_quote(posixpath.dirname(mirror_path)),
+                   repo=shell_quote(self.repo_url()),
+                   config=self.MIRROR_CONFIG,
+               )
+
+    def _fetch_source(self):
+        """ Where objects are fetched from: the mirror if mirror_dir is set, origin otherwise
+        """
+        mirror_path = self.mirror_path()
+
+        return shell_quote(mirror_path) if mirror_path else 'origin'
+
+    def _batch_fetch(self, batch, force=False):
+        """ Add fetch (and refs snapshot) to the batch unless the repository is still fresh (see fetch_ttl)
+        """
+        if not force and self.is_fetch_fresh():
+            return None
+
+        mirror_path = self.mirror_path()
+
+        if mirror_path is None:
+            # Prune so branches deleted on origin are not in the refs snapshot (see has_revision)
+            return None, batch.add('git fetch --prune origin', silent=False), batch.add(self.REFS_SNAPSHOT_CMD, raw=True)
+
+        # Fetch from the (shared) mirror instead of origin, the mirror itself is fetched once per fetch_ttl
+        mirror = self._batch_update_mirror(batch, force=force)
+        fetch = batch.add("git fetch --prune %s '+refs/heads/*:refs/remotes/origin/*' '+refs/tags/*:refs/tags/*'" %
+                          shell_quote(mirror_path))
+
+        return mirror, fetch, batch.add(self.REFS_SNAPSHOT_CMD, raw=True)
+
+    def _batch_fetch_result(self, fetch):
+        if fetch is not None:
+            mirror, fetch, refs = fetch
+
+            self._batch_update_mirror_result(mirror)
+            fetch.result()
+
+            self.mark_fetched()
+            self._set_refs_snapshot(refs.result())
+
+    def _set_refs_snapshot(self, result):
+        lines = [x.strip() for x in result.strip().splitlines(False)]
+        refs = {}
+
+        for line in lines[3:]:
+            commit_id, _, ref = line.partition(' ')
+            refs[ref] = commit_id
+
+        info = self._fetch_info()
+        info['shallow'] = bool(lines) and lines[0] == 'true'
+
+        # Clones made with --single-branch only fetch (and thus only know) the branches listed in their refspecs
+        info['single_branch'] = not any('*' in x for x in (lines[2] if len(lines) > 2 else '').split())
+        info['refs'] = (lines[1] if len(lines) > 1 else None, refs)
+
+    def get_refs_snapshot(self):
+        """ Get the origin url and refs of the repository on the target machine
+
+            The snapshot is taken together with each fetch and shared by all instances using the same code_dir.
+
+        :return: (origin_url, {refname: commit_id})
+        :rtype: tuple
+        """
+        info = self._fetch_info()
+
+        if info.get('refs') is None:
+            with self.cd(self.code_dir):
+                self._set_refs_snapshot(self.remote_cmd(self.REFS_SNAPSHOT_CMD, silent=True, raw=True))
+
+        return info['refs']
 
-    def has_revision(self, revision, locally=False):
+    def invalidate_refs_snapshot(self):
+        info = self._fetch_info()
+        info['refs'] = None
+
+        # Revsets can refer to refs which just moved
+        info.pop('changesets', None)
+
+    def is_shallow(self):
+        """ Check if the repository on the target machine is a shallow clone
+
+        :rtype: bool
+        """
+        self.get_refs_snapshot()
+
+        return self._fetch_info()['shallow']
+
+    def is_single_branch(self):
+        """ Check if the repository on the target machine only fetches some branches (e.g. a --single-branch clone)
+
+        :rtype: bool
+        """
+        self.get_refs_snapshot()
+
+        return self._fetch_info()['single_branch']
+
+    def _ensure_history(self, revision, with_merge_base=False):
+        """ Deepen a shallow clone until the revision (and optionally its merge base with HEAD) is available
+        """
+        if not self.is_shallow():
+            return
+
+        check = 'git cat-file -e %s 2>/dev/null' % shell_quote('%s^{commit}' % revision)
+
+        if with_merge_base:
+            check += ' && git merge-base HEAD %s' % shell_quote(revision)
+
+        depth = self.DEEPEN_STEP
+
+        for attempt in range(self.DEEPEN_ATTEMPTS):
+            batch = self.batch()
+            available = batch.add(check)
+            batch.execute()
+
+            if available.ok:
+                return
+
+            print(yellow('Revision %s is not available in the shallow clone, fetching %d more commits' % (revision, depth)))
+            self.remote_cmd('git fetch --deepen=%d %s' % (depth, self._fetch_source()), silent=True)
+            self.invalidate_refs_snapshot()
+            depth *= 2
+
+        batch = self.batch()
+        available = batch.add(check)
+        batch.execute()
+
+        if available.ok:
+            return
+
+        print(yellow('Revision %s is still not available, fetching the full history' % revision))
+        self.remote_cmd('git fetch --unshallow %s' % self._fetch_source(), silent=True)
+        self.invalidate_refs_snapshot()
+
+    def _has_branch_cmd(self, revision, locally=False):
         if revision.startswith('origin/'):
             revision_without_origin = revision[len('origin/'):]
         else:
@@ -271,11 +667,42 @@ class Git(BaseVcs):
             repo_url = self.repo_url()
 
         # Returns 1 if this revision (branch) exists on the remote repo or 0 if it does not.
-        cmd = u'git ls-remote --heads {repo_url} {revision} | wc -l'.format(
+        return u'git ls-remote --heads {repo_url} {revision} | wc -l'.format(
             repo_url=repo_url, revision=revision_without_origin,
         )
 
-        has_branch = self.remote_cmd(cmd)
+    def _has_branch_in_snapshot(self, revision, locally=False):
+        if revision.startswith('origin/'):
+            revision = revision[len('origin/'):]
+
+        ref = ('refs/heads/%s' if locally else 'refs/remotes/origin/%s') % revision
+
+        return 1 if ref in self.get_refs_snapshot()[1] else 0
+
+    def has_revision(self, revision, locally=False, has_branch=None, ls_remote=None):
+        """ Check if the revision exists in the remote repository (or locally on the target machine)
+
+            By default branches are looked up from the refs fetched by the last pull (see get_refs_snapshot),
+            use `ls_remote` to query the remote repository directly instead.
+
+        :param revision: Branch name or commit id
+        :param locally: Check the repository on the target machine instead of the remote repository
+        :param has_branch: Output of the `ls-remote` branch check if it was already run (e.g. as part of a batch)
+        :param ls_remote: Use `git ls-remote` for the branch check (defaults to the ls_remote init kwarg)
+        """
+        if ls_remote is None:
+            ls_remote = self.ls_remote
+
+        if has_branch is None:
+            if ls_remote:
+                has_branch = self.remote_cmd(self._has_branch_cmd(revision, locally=locally), raw=True)
+
+            else:
+                has_branch = self._has_branch_in_snapshot(revision, locally=locally)
+
+                # Single-branch clones don't know about the other remote branches, ask the remote repository
+                if not has_branch and not locally and self.is_single_branch():
+                    has_branch = self.remote_cmd(self._has_branch_cmd(revision), raw=True)
 
         if not int(has_branch):
             try:
@@ -304,7 +731,53 @@ class Git(BaseVcs):
     def _commit_id_is_too_short(revision):
         return u'The commit id given is too short: {}'.format(revision)
 
-    def _get_revision_and_base_branch(self, revision):
+    @staticmethod
+    def _is_branch_name(revision):
+        if not revision:
+            return False
+
+        try:
+            int(revision, 16)
+
+        except ValueError:
+            return True
+
+        return False
+
+    def _fetch_and_get_revision(self, revision):
+        """ Fetch and resolve the revision to use (see _get_revision_and_base_branch)
+
+            The fetch and the branch existence checks are executed in a single remote command. If the repository
+            is still fresh (see fetch_ttl) the fetch is skipped and a previously resolved revision is reused.
+        """
+        resolved = self.get_resolved_revision(revision)
+
+        if resolved is not None:
+            return resolved
+
+        batch = self.batch()
+        fetch = self._batch_fetch(batch)
+
+        branch_checks = {}
+
+        if self.ls_remote and self._is_branch_name(revision):
+            for locally in (False, True):
+                branch_checks[locally] = batch.add(self._has_branch_cmd(revision, locally=locally), raw=True)
+
+        batch.execute()
+
+        self._batch_fetch_result(fetch)
+
+        resolved = self._get_revision_and_base_branch(revision, branch_checks=dict([
+            (locally, command.result()) for locally, command in branch_checks.items()
+        ]))
+
+        self.set_resolved_revision(revision, resolved)
+
+        return resolved
+
+    def _get_revision_and_base_branch(self, revision, branch_checks=None):
+        branch_checks = branch_checks or {}
         base_branch = None
         on_new_branch = False
         revision_is_branch = False
@@ -324,18 +797,26 @@ class Git(BaseVcs):
                 revision_is_branch = True
 
                 # Make sure that this branch exists in the remote repo.
-                if not self.has_revision(revision):
+                if not self.has_revision(revision, has_branch=branch_checks.get(False)):
                     abort(red(self._no_revision_error(revision)))
 
                 # If this branch does not exist locally, we need to
                 # create it so that the branch searching alg. works.
-                if not self.has_revision(revision, locally=True):
+                if not self.has_revision(revision, locally=True, has_branch=branch_checks.get(True)):
                     on_new_branch = True
-                    cmd = u'git fetch origin {0}:{0}'.format(revision)
+                    cmd = u'git fetch {0} {1}:{1}'.format(self._fetch_source(), revision)
+
+                    if self.is_single_branch():
+                        # Track the branch from now on, the refspecs of the clone don't include it
+                        cmd = u'git remote set-branches --add origin {1} && ' \
+                              u'git fetch {0} {1}:{1} +refs/heads/{1}:refs/remotes/origin/{1}'.format(
+                                  self._fetch_source(), revision)
+
                     msg_tmpl = u'Not a commit ID and the branch exists remotely. ' \
                                u'Now creating this branch locally: {} with this command: {}'
                     print(yellow(msg_tmpl.format(revision, cmd)))
                     self.remote_cmd(cmd, silent=True)
+                    self.invalidate_refs_snapshot()
                     revision = u'origin/{}'.format(revision)
 
         # If no revision was given we should use the local branch.
@@ -357,51 +838,45 @@ class Git(BaseVcs):
             revision = ''
 
         with self.cd(self.code_dir):
-            self.pull()
-
-            revision, base_branch = self._get_revision_and_base_branch(revision)
+            revision, base_branch = self._fetch_and_get_revision(revision)
+            self._ensure_history(revision)
 
             self.remote_cmd(u'git checkout {}'.format(revision))
 
+            # Resolving the current branch depends on the working copy, so it has to be done again
+            self.forget_resolved_revisions()
+
     def get_all_branches(self, remote):
         with self.cd(self.code_dir):
-            all_branches = self.remote_cmd('git --no-pager branch%s --color=never' % (' -r' if remote else ' -l'), silent=True)
+            all_branches = self.remote_cmd('git --no-pager branch%s --color=never' % (' -r' if remote else ' -l'), silent=True, raw=True)
             all_branches = [x.strip() for x in all_branches.splitlines(False)]
 
             return set(list(filter(lambda y: y, map(self.normalize_branch, all_branches))))
 
     def get_commit_id(self):
         with self.cd(self.code_dir):
-            return self.remote_cmd('git --no-pager log -n 1 --oneline --pretty=%h', silent=True).strip()
+            return self.remote_cmd('git --no-pager log -n 1 --oneline --pretty=%h', silent=True, raw=True).strip()
 
     def git_what_branch(self, commit_id, remote=False):
         if commit_id.lower() == 'head':
             commit_id = self.get_commit_id()
 
-        if self._branch_cache.get(commit_id, None) is not None:
-            return [self._branch_cache[commit_id], ], commit_id
-
-        with self.cd(self.code_dir):
-            all_branches = self.get_all_branches(remote=remote)
-            valid_branches = []
+        cached_branch = self._get_cached_branch(commit_id)
 
-            for branch in all_branches:
-                try:
-                    commit_log = self.remote_cmd(('git --no-pager log --oneline '
-                                                  '%(branch)s origin/%(branch)s --pretty=%%h | grep %(commit)s') % dict(
-                        branch=branch,
-                        commit=commit_id,
-                    ), silent=True)
+        if cached_branch is not None:
+            return [cached_branch, ], commit_id
 
-                    if commit_log and commit_id in commit_log:  # pragma: no branch
-                        valid_branches.append(branch)
+        with self.cd(self.code_dir):
+            # Test whether the commit is reachable from each branch with a single remote command: for-each-ref
+            #  generates a `git merge-base --is-ancestor` check per branch which is then executed by the remote shell.
+            check = 'git merge-base --is-ancestor %s %%(refname) 2>/dev/null && echo %%(refname) || true' % shell_quote(commit_id)
 
-                except UnexpectedExit as e:
-                    if e.code == 1:
-                        continue
+            result = self.remote_cmd('git for-each-ref --shell --format=%(format)s %(refs)s | sh' % dict(
+                format=shell_quote(check),
+                refs='refs/remotes/' if remote else 'refs/heads/',
+            ), silent=True, raw=True)
 
-                    else:
-                        raise  # pragma: no cover
+            valid_branches = sorted(set(filter(lambda y: y, map(self._cleanup_branch_name, result.strip().splitlines(False)))))
 
         return valid_branches, commit_id
 
@@ -414,12 +889,21 @@ class Git(BaseVcs):
 
         with self.cd(self.code_dir):
             # First lets pull
-            self.pull()
+            revision, base_branch = self._fetch_and_get_revision(revision)
+            self._ensure_history(revision, with_merge_base=True)
 
-            revision, base_branch = self._get_revision_and_base_branch(revision)
+            # Get both forwards and backwards logs with a single remote command
+            batch = self.batch()
 
             revision_set = self.get_revset(' ', revision)
-            revisions = self.get_revset_log(revision_set, base_branch=base_branch)
+            forwards = batch.add(self._revset_log_cmd(revision_set))
+
+            backwards_revision_set = self.get_revset(revision, ' ')
+            backwards = batch.add(self._revset_log_cmd(backwards_revision_set))
+
+            batch.execute()
+
+            revisions = self._parse_revset_log(forwards.result(), base_branch=base_branch)
             print(' ')
 
             if len(revisions) > 0:
@@ -427,8 +911,8 @@ class Git(BaseVcs):
                 return {'forwards': self.get_revisions(revisions), 'revset': revision_set}
 
             # Check if target is backwards from the current revision:
-            revision_set = self.get_revset(revision, ' ')
-            revisions = self.get_revset_log(revision_set, base_branch=base_branch)
+            revision_set = backwards_revision_set
+            revisions = self._parse_revset_log(backwards.result(), base_branch=base_branch)
             print(' ')
 
             if revisions:
@@ -437,22 +921,80 @@ class Git(BaseVcs):
                 return {'message': "Already at target revision"}
 
     def _changed_files(self, revision_set):
+        # Renames and copies are reported as deleted and added files (like before rename detection was added), so
+        #  filters on the action keep working. They are only detected by get_changeset.
+        return (change.entry for change in self._diff_name_status(revision_set, '--no-renames'))
+
+    def _changed_file_records(self, revision_set):
+        return self._diff_name_status(revision_set, '-M -C')
+
+    def _diff_name_status(self, revision_set, options):
         with self.cd(self.code_dir):
-            result = self.remote_cmd("git --no-pager diff --name-status %s" % revision_set, silent=True).splitlines()
+            # -z keeps paths verbatim (no quoting) and NUL separated so any file name is safe to parse
+            result = self.remote_cmd("git --no-pager diff --name-status %s -z %s" % (options, revision_set),
+                                     silent=True, raw=True)
+
+        return self.parse_name_status(result)
+
+    @staticmethod
+    def parse_name_status(output):
+        """ Parse `git diff --name-status -z` output into FileChange records
+
+            Renames and copies (`-M`/`-C`) are reported as a single record with both paths and the similarity.
+
+        :raises ValueError: if the output is truncated (a status without its paths)
+        :rtype: generator
+        """
+        fields = output.strip('\n').split('\0')
 
-            return list(map(lambda x: x.replace('\t', ' '), result))
+        # Output ends with a NUL, so the last field is empty
+        if fields and not fields[-1]:
+            fields.pop()
+
+        i = 0
+
+        while i < len(fields):
+            status = fields[i].strip()
+            count = 2 if status[:1] in ('R', 'C') else 1
+
+            if not status or i + count >= len(fields):
+                raise ValueError('Truncated git diff --name-status output: %r' % '\0'.join(fields[i:]))
+
+            paths = fields[i + 1:i + 1 + count]
+            i += 1 + count
+
+            if count == 2:
+                yield FileChange(status[0], paths[1], old_path=paths[0], similarity=int(status[1:]) if status[1:] else None)
+
+            else:
+                yield FileChange(status[0], paths[0])
+
+    @staticmethod
+    def _revset_log_cmd(revs):
+        return "git --no-pager log --oneline --format='%%H %%h {} %%an <%%ae> %%s' %s" % revs
 
     def get_revset_log(self, revs, base_branch=None):
         with self.cd(self.code_dir):
-            result = self.remote_cmd("git --no-pager log --oneline --format='%%h {} %%an <%%ae> %%s' %s" % revs, silent=True).strip()
+            return self._parse_revset_log(self.remote_cmd(self._revset_log_cmd(revs), silent=True), base_branch=base_branch)
+
+    def _parse_revset_log(self, result, base_branch=None):
+        result = result.strip()
+
+        if result:
+            result = list(filter(lambda y: y, [x.strip() for x in result.split('\n')]))
+
+            # Remember the full hashes (used by the persistent branch cache) and strip them from the lines
+            for i, line in enumerate(result):
+                full_commit_id, result[i] = line.split(' ', 1)
+                self._full_commit_ids[result[i].split()[0]] = full_commit_id
 
-            if result:
-                result = result.split('\n')
+            # Resolve the branches of all the commits in one go instead of one-by-one in log_add_branch
+            if base_branch is None:
+                self.resolve_branches([x.split()[0] for x in result])
 
-                return list(map(lambda z: self.log_add_branch(z, base_branch=base_branch),
-                                filter(lambda y: y, [x.strip() for x in result])))
+            return list(map(lambda z: self.log_add_branch(z, base_branch=base_branch), result))
 
-            return []
+        return []
 
     def log_add_branch(self, line, base_branch=None):
         if not line:
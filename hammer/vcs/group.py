@@ -0,0 +1,160 @@
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from hammer.util import is_fabric1
+
+from .manager import VcsProxy
+
+
+class VcsGroupResult(dict):
+    """ Results of a VcsGroup operation, mapping host -> return value of the operation on that host
+
+        Hosts where the operation raised an exception are listed in `failed` (host -> exception) instead.
+
+        Timing information:
+
+        - elapsed:              Wall-clock time the whole operation took
+        - durations:            Time the operation took per host
+        - sequential_elapsed:   Sum of durations, e.g. roughly how long running it host-by-host would have taken
+        - saved:                Wall-clock time saved by running the operation concurrently
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(VcsGroupResult, self).__init__(*args, **kwargs)
+
+        self.failed = OrderedDict()
+        self.durations = OrderedDict()
+        self.elapsed = 0.0
+
+    @property
+    def succeeded(self):
+        return dict(self)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    @property
+    def sequential_elapsed(self):
+        return sum(self.durations.values())
+
+    @property
+    def saved(self):
+        return max(self.sequential_elapsed - self.elapsed, 0.0)
+
+
+class VcsGroup(object):
+    """ Run vcs operations concurrently on several hosts
+
+        >>> group = VcsGroup(project_root=os.path.dirname(os.path.dirname(__file__)),
+        >>>                  connections=[Connection('app1.foo.bar'), Connection('app2.foo.bar')],
+        >>>                  use_sudo=True, code_dir='/srv/myproject')
+        >>>
+        >>> result = group.update('master')
+        >>> print(result.failed, result.saved)
+
+        Note: Only supported with fabric2 since fabric1 keeps the active host in global state.
+
+        Results are keyed by host (see get_host), so each host can only be given once.
+
+    :param project_root: Root directory of project
+    :param connections: Fabric Connections of the target hosts (raises ValueError for duplicate hosts)
+    :param workers: Maximum number of hosts to run operations on concurrently (defaults to the number of hosts)
+    :param init_kwargs: Passed on to Vcs.init for each host
+    """
+
+    def __init__(self, project_root, connections, workers=None, **init_kwargs):
+        if is_fabric1:
+            raise EnvironmentError('VcsGroup is only supported with fabric2')
+
+        self.workers = workers
+        self.members = OrderedDict()
+
+        for connection in connections:
+            host = self.get_host(connection)
+
+            # The results of the second connection would overwrite the ones of the first
+            if host in self.members:
+                raise ValueError('Host %s is given more than once' % host)
+
+            vcs = VcsProxy.init(project_root=project_root, **init_kwargs)
+            vcs.attach_context(connection)
+
+            self.members[host] = vcs
+
+    @staticmethod
+    def get_host(connection):
+        return getattr(connection, 'original_host', None) or connection.host
+
+    def call(self, method_name, *args, **kwargs):
+        """ Call the given vcs method concurrently on all hosts
+
+        :param method_name: Name of the vcs method to call (e.g. `update`)
+        :rtype: VcsGroupResult
+        """
+        def run(item):
+            host, vcs = item
+            started = time.time()
+
+            try:
+                return host, getattr(vcs, method_name)(*args, **kwargs), None, time.time() - started
+
+            except Exception as e:
+                return host, None, e, time.time() - started
+
+        result = VcsGroupResult()
+
+        if not self.members:
+            return result
+
+        pool = ThreadPool(min(self.workers or len(self.members), len(self.members)))
+        started = time.time()
+
+        try:
+            outcomes = pool.map(run, list(self.members.items()))
+
+        finally:
+            pool.close()
+            pool.join()
+
+        result.elapsed = time.time() - started
+
+        for host, value, error, duration in outcomes:
+            result.durations[host] = duration
+
+            if error is not None:
+                result.failed[host] = error
+
+            else:
+                result[host] = value
+
+        return result
+
+    def pull(self):
+        """ Run BaseVcs.pull on all hosts
+
+        :rtype: VcsGroupResult
+        """
+        return self.call('pull')
+
+    def update(self, revision=''):
+        """ Run BaseVcs.update on all hosts
+
+        :rtype: VcsGroupResult
+        """
+        return self.call('update', revision)
+
+    def version(self):
+        """ Run BaseVcs.version on all hosts
+
+        :rtype: VcsGroupResult
+        """
+        return self.call('version')
+
+    def deployment_list(self, revision=''):
+        """ Run BaseVcs.deployment_list on all hosts
+
+        :rtype: VcsGroupResult
+        """
+        return self.call('deployment_list', revision)
@@ -1,88 +1,179 @@
 import os
-from subprocess import CalledProcessError, check_output
+import posixpath
 
-from hammer.util import abort, as_str
+from hammer.util import abort, shell_quote
 
 from .base import BaseVcs
+from .changes import FileChange, iter_lines
+from .local import hg_paths
 
 
 class Mercurial(BaseVcs):
     TAG = 'hg'
     NAME = 'Mercurial'
 
+    # hg status codes which differ from the ones used in FileChange (R is removed, ! is missing)
+    STATUS_ACTIONS = {
+        'R': 'D',
+        '!': 'D',
+    }
+
     def version(self):
         with self.cd(self.code_dir):
-            commit_id, branch = self.remote_cmd('hg id -nb', silent=True).split()
-
             separator = ':|:|:'
-            c_hash, author, message = self.remote_cmd(("hg --config ui.color=never --config ui.paginate=never log --template "
-                                                       "'{node|short}%(sep)s{author}%(sep)s{desc|firstline}\\n' -r %(id)s") % dict(
-                sep=separator,
-                id=commit_id,
-            ), silent=True).split(separator)
+
+            # Get the id and info of the working directory parent with a single remote command
+            batch = self.batch()
+            identify = batch.add('hg id -nb')
+            log = batch.add(("hg --config ui.color=never --config ui.paginate=never log --template "
+                             "'{node|short}%(sep)s{author}%(sep)s{desc|firstline}\\n' -r .") % dict(sep=separator))
+            batch.execute()
+
+            commit_id, branch = identify.result().split()
+            c_hash, author, message = log.result().split(separator)
 
             commit_id = '%s:%s' % (commit_id, c_hash)
 
         return commit_id, branch, message, author
 
     def repo_url(self):
-        try:
-            result = as_str(check_output(['sh', '-c', 'hg paths default'], cwd=self.project_root)).rstrip('\n')
+        # Read from the local hgrc (memoized)
+        return dict(hg_paths(self.project_root)).get('default') or None
 
-        except CalledProcessError as e:
-            if e.returncode == 1:
-                result = None
+    def clone(self, revision=None, uncompressed=False, share_from=None):
+        """ Clones the project to a target machine. Will abort if something goes wrong.
 
-            else:
-                raise  # pragma: no cover
+        :param revision: Can be used to specify a branch or commit that should be activated after cloning.
+        :param uncompressed: Use streaming (uncompressed) clone, faster on fast networks (--uncompressed)
+        :param share_from: Path to a local repository on the target machine to share the history store with, the
+                           clone is created via the share extension and its default path is set to the repo url.
 
-        return result or None
-
-    def clone(self, revision=None):
+            If mirror_dir is set the mirror is updated and shared with the clone (unless share_from is given).
+        """
         repo_url = self.repo_url()
 
         if not repo_url:
             abort('Repo url was not found')  # pragma: no cover
 
-        self.remote_cmd('hg clone %s %s' % (repo_url, self.code_dir))
+        batch = self.batch()
+        mirror = self._batch_update_mirror(batch)
+        share_from = share_from or self.mirror_path()
+
+        if share_from:
+            batch.add('hg --config extensions.share= share -U %s %s' % (shell_quote(share_from), shell_quote(self.code_dir)))
+            batch.add('printf %s %s > %s' % (
+                shell_quote('[paths]\ndefault = %s\n'), shell_quote(repo_url), shell_quote(posixpath.join(self.code_dir, '.hg', 'hgrc')),
+            ))
+            batch.execute()
+
+            self._batch_update_mirror_result(mirror)
+
+            for command in batch.commands:
+                command.result()
+
+            # The shared store may be behind origin, update pulls before activating the revision
+            self.invalidate_fetch()
+            self.update(revision)
+            return
+
+        self.remote_cmd('hg clone %s%s %s' % ('--uncompressed ' if uncompressed else '', repo_url, self.code_dir))
+        self.mark_fetched()
 
         if revision:
             self.update(revision)
 
     def get_branch(self):
         with self.cd(self.code_dir):
-            return self.remote_cmd('hg id -b', silent=True).strip()
+            return self.remote_cmd('hg id -b', silent=True, raw=True).strip()
 
-    def pull(self):
+    def pull(self, force=False):
         with self.cd(self.code_dir):
-            self.remote_cmd('hg pull', silent=True)
+            batch = self.batch()
+            pull = self._batch_pull(batch, force=force)
+
+            if pull is not None:
+                batch.execute()
+                self._batch_pull_result(pull)
+
+    def _mirror_update_cmd(self, mirror_path):
+        return 'if [ -d %(path)s/.hg ]; then hg pull -q -R %(path)s; ' \
+               'else mkdir -p %(dir)s && hg clone -U -q %(repo)s %(path)s; fi' % dict(
+                   path=shell_quote(mirror_path),
+                   dir=shell_quote(posixpath.dirname(mirror_path)),
+                   repo=shell_quote(self.repo_url()),
+               )
+
+    def _batch_pull(self, batch, force=False):
+        """ Add `hg pull` to the batch unless the repository is still fresh (see fetch_ttl)
+        """
+        if not force and self.is_fetch_fresh():
+            return None
+
+        mirror_path = self.mirror_path()
+
+        if mirror_path is None:
+            return None, batch.add('hg pull')
+
+        # Pull from the (shared) mirror instead of the default path, the mirror itself is pulled once per fetch_ttl
+        return self._batch_update_mirror(batch, force=force), batch.add('hg pull %s' % shell_quote(mirror_path))
+
+    def _batch_pull_result(self, pull):
+        if pull is not None:
+            mirror, pull = pull
+
+            self._batch_update_mirror_result(mirror)
+            pull.result()
+            self.mark_fetched()
 
     def update(self, revision=''):
         # Default revision to empty string if it is None
         revision = revision or ''
 
-        self.pull()
-
         with self.cd(self.code_dir):
-            self.remote_cmd('hg update %s' % revision)
+            # Pull and update with a single remote command
+            batch = self.batch()
+            pull = self._batch_pull(batch)
+            update = batch.add('hg update %s' % revision, silent=False)
+            batch.execute()
 
-    def get_revset_log(self, revs):
-        with self.cd(self.code_dir):
-            result = self.remote_cmd("hg --config ui.color=never --config ui.paginate=never log --template '{rev}:{node|short} {branch} "
-                                     "{author} {desc|firstline}\\n' -r '%s'" % revs, silent=True)
+            self._batch_pull_result(pull)
+            update.result()
+
+            # Revsets like `.::X` depend on the working copy, so anything resolved before the update is stale
+            self.forget_resolved_revisions()
+
+    @staticmethod
+    def _revset_log_cmd(revs):
+        return ("hg --config ui.color=never --config ui.paginate=never log --template '{rev}:{node|short} {branch} "
+                "{author} {desc|firstline}\\n' -r '%s'" % revs)
 
-            if not result:
-                return []
+    @staticmethod
+    def _parse_revset_log(result):
+        if not result:
+            return []
 
-            return list(filter(lambda y: y, [x.strip() for x in (result.split('\n') or [])]))
+        return list(filter(lambda y: y, [x.strip() for x in (result.split('\n') or [])]))
+
+    def get_revset_log(self, revs):
+        with self.cd(self.code_dir):
+            return self._parse_revset_log(self.remote_cmd(self._revset_log_cmd(revs), silent=True))
 
     def deployment_list(self, revision=''):
         with self.cd(self.code_dir):
-            # First lets pull
-            self.pull()
+            # Pull and get both forwards and backwards logs with a single remote command
+            batch = self.batch()
+            pull = self._batch_pull(batch)
 
             revision_set = self.get_revset('.', revision)
-            revisions = self.get_revset_log(revision_set)
+            forwards = batch.add(self._revset_log_cmd(revision_set))
+
+            backwards_revision_set = self.get_revset(revision, '.')
+            backwards = batch.add(self._revset_log_cmd(backwards_revision_set))
+
+            batch.execute()
+
+            self._batch_pull_result(pull)
+            revisions = self._parse_revset_log(forwards.result())
 
             if len(revisions) > 1:
                 # Target is forward of the current rev
@@ -93,8 +184,8 @@ class Mercurial(BaseVcs):
                 return {'message': "Already at target revision"}
 
             # Check if target is backwards of the current rev
-            revision_set = self.get_revset(revision, '.')
-            revisions = self.get_revset_log(revision_set)
+            revision_set = backwards_revision_set
+            revisions = self._parse_revset_log(backwards.result())
 
             if revisions:
                 return {'backwards': list(reversed(self.get_revisions(revisions))), 'revset': revision_set}
@@ -105,9 +196,15 @@ class Mercurial(BaseVcs):
     def _changed_files(self, revision_set):
         with self.cd(self.code_dir):
             result = self.remote_cmd("hg --config ui.color=never --config ui.paginate=never status --rev '%s'" % revision_set,
-                                     silent=True).splitlines()
+                                     silent=True, raw=True)
+
+        return iter_lines(result)
+
+    def _changed_file_records(self, revision_set):
+        for line in self._changed_files(revision_set):
+            action, _, path = line.partition(' ')
 
-            return result
+            yield FileChange(self.STATUS_ACTIONS.get(action, action), path)
 
     @classmethod
     def get_revset(cls, x, y):
@@ -0,0 +1,289 @@
+""" Inspect the local (developer machine) repository without spawning vcs processes
+
+    Remotes are read directly from `.git/config` / `.hg/hgrc` and memoized per config file. The memoized value is
+    refreshed automatically when the config file changes. If the config can't be handled by the simple parser
+    (e.g. it uses includes) the vcs binary is used as a fallback.
+"""
+import os
+import re
+from subprocess import CalledProcessError, check_output
+
+from hammer.util import as_str
+
+
+# (kind, path) -> (stamp, remotes)
+_remotes_cache = {}
+
+_section_re = re.compile(r'^\s*\[\s*([^\]"\s]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(.*)$')
+_option_re = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:=\s*(.*))?$')
+
+
+def find_repo_dir(path, marker):
+    """ Find the closest directory (starting from path and walking up) which contains marker (e.g. `.git`)
+
+    :return: Path of the directory or None if not found
+    """
+    path = os.path.abspath(path)
+
+    while True:
+        if os.path.exists(os.path.join(path, marker)):
+            return path
+
+        parent = os.path.dirname(path)
+
+        if parent == path:
+            return None
+
+        path = parent
+
+
+def _stamp(path):
+    try:
+        stat = os.stat(path)
+
+    except OSError:
+        return None
+
+    return stat.st_mtime, stat.st_size
+
+
+def _memoized(kind, path, parser, fallback):
+    stamp = _stamp(path)
+    cached = _remotes_cache.get((kind, path))
+
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    remotes = None
+
+    if stamp is not None:
+        with open(path, 'rb') as handle:
+            remotes = parser(as_str(handle.read()))
+
+    if remotes is None:
+        remotes = fallback()
+
+    _remotes_cache[(kind, path)] = (stamp, remotes)
+
+    return remotes
+
+
+def _git_value(value):
+    value = (value or '').strip()
+    result = []
+    quoted = False
+    i = 0
+
+    while i < len(value):
+        char = value[i]
+
+        if char == '\\' and i + 1 < len(value):
+            result.append({'n': '\n', 't': '\t', 'b': '\b'}.get(value[i + 1], value[i + 1]))
+            i += 2
+            continue
+
+        if char == '"':
+            quoted = not quoted
+
+        elif char in '#;' and not quoted:
+            break
+
+        else:
+            result.append(char)
+
+        i += 1
+
+    return ''.join(result).strip()
+
+
+def parse_git_remotes(config):
+    """ Parse remotes from contents of a git config file
+
+    :return: List of (name, url) tuples or None if the config can't be handled without git
+    """
+    remotes = []
+    urls = {}
+    section = None
+
+    for line in config.splitlines():
+        stripped = line.strip()
+
+        if not stripped or stripped[0] in '#;':
+            continue
+
+        if stripped.startswith('['):
+            match = _section_re.match(stripped)
+
+            if not match:
+                return None
+
+            name, subsection, rest = match.groups()
+            name = name.lower()
+
+            if name in ('include', 'includeif'):
+                return None
+
+            # Legacy [remote.origin] syntax
+            if subsection is None and '.' in name:
+                name, subsection = name.split('.', 1)
+
+            section = (name, subsection)
+            stripped = rest.strip()
+
+            if not stripped:
+                continue
+
+        match = _option_re.match(stripped)
+
+        if not match or section is None:
+            continue
+
+        key, value = match.groups()
+
+        if section[0] == 'remote' and section[1] is not None and key.lower() == 'url':
+            if section[1] not in urls:
+                remotes.append(section[1])
+
+            urls[section[1]] = _git_value(value)
+
+    return [(name, urls[name]) for name in remotes]
+
+
+def _git_config_path(repo_dir):
+    git_dir = os.path.join(repo_dir, '.git')
+
+    if os.path.isfile(git_dir):
+        # Worktrees/submodules: .git is a file pointing to the real git dir
+        with open(git_dir, 'r') as handle:
+            content = handle.read().strip()
+
+        if not content.startswith('gitdir:'):
+            return None
+
+        git_dir = os.path.join(repo_dir, content[len('gitdir:'):].strip())
+
+    common_dir = os.path.join(git_dir, 'commondir')
+
+    if os.path.isfile(common_dir):
+        with open(common_dir, 'r') as handle:
+            git_dir = os.path.join(git_dir, handle.read().strip())
+
+    return os.path.normpath(os.path.join(git_dir, 'config'))
+
+
+def git_remotes(project_root):
+    """ Get remotes of the local git repository containing project_root
+
+    :return: List of (name, url) tuples
+    :rtype: list
+    """
+    repo_dir = find_repo_dir(project_root, '.git') or os.path.abspath(project_root)
+    config_path = _git_config_path(repo_dir)
+
+    def fallback():
+        try:
+            output = as_str(check_output(['git', 'config', '--get-regexp', r'^remote\..*\.url$'], cwd=project_root))
+
+        except CalledProcessError as e:
+            if e.returncode == 1:
+                return []
+
+            raise  # pragma: no cover
+
+        remotes = []
+
+        for line in output.splitlines():
+            key, _, url = line.partition(' ')
+            remotes.append((key[len('remote.'):-len('.url')], url.strip()))
+
+        return remotes
+
+    if config_path is None:
+        return fallback()  # pragma: no cover
+
+    return _memoized('git', config_path, parse_git_remotes, fallback)
+
+
+def parse_hg_paths(config, repo_dir):
+    """ Parse [paths] from contents of a hgrc file
+
+    :return: List of (name, url) tuples or None if the config can't be handled without hg
+    """
+    paths = []
+    section = None
+    last_key = None
+
+    for line in config.splitlines():
+        if not line.strip() or line.lstrip()[0] in '#;':
+            continue
+
+        if line.startswith('%'):
+            # %include / %unset
+            return None
+
+        if line[0] in ' \t':
+            # Continuation of the previous value
+            if section == 'paths' and last_key is not None:
+                name, url = paths[-1]
+                paths[-1] = (name, (url + ' ' + line.strip()).strip())
+
+            continue
+
+        stripped = line.strip()
+
+        if stripped.startswith('['):
+            section = stripped.strip('[]').strip()
+            last_key = None
+            continue
+
+        key, sep, value = stripped.partition('=')
+
+        if not sep:
+            continue
+
+        last_key = key.strip()
+
+        if section == 'paths':
+            paths = [x for x in paths if x[0] != last_key]
+            paths.append((last_key, value.strip()))
+
+    def expand(url):
+        # hg resolves relative local paths against the repository root
+        if url and '://' not in url and not os.path.isabs(url):
+            return os.path.normpath(os.path.join(repo_dir, os.path.expanduser(url)))
+
+        return url
+
+    return [(name, expand(url)) for name, url in paths]
+
+
+def hg_paths(project_root):
+    """ Get paths (remotes) of the local mercurial repository containing project_root
+
+    :return: List of (name, url) tuples
+    :rtype: list
+    """
+    repo_dir = find_repo_dir(project_root, '.hg') or os.path.abspath(project_root)
+
+    def fallback():
+        try:
+            output = as_str(check_output(['hg', 'paths'], cwd=project_root))
+
+        except CalledProcessError as e:
+            if e.returncode == 1:
+                return []
+
+            raise  # pragma: no cover
+
+        return [tuple(x.strip() for x in line.split(' = ', 1)) for line in output.splitlines() if ' = ' in line]
+
+    def parser(config):
+        paths = parse_hg_paths(config, repo_dir)
+
+        # The default path can also come from user/system wide config files
+        if paths is not None and 'default' not in dict(paths):
+            return None
+
+        return paths
+
+    return _memoized('hg', os.path.join(repo_dir, '.hg', 'hgrc'), parser, fallback)
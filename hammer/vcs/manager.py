@@ -1,40 +1,167 @@
-from .git import Git
-from .hg import Mercurial
+import importlib
+import os
+
+
+# (proxy class, absolute project root, search_parents) -> handler class
+_detect_cache = {}
+
+
+class LazyHandler(object):
+    """ Vcs handler which is only imported once its marker (e.g. `.git`) is found in the project root
+
+        The marker is only a cheap pre-check, the handler's own detect makes the final decision.
+
+    :param path: Dotted path of the handler class (e.g. `hammer.vcs.git.Git`)
+    :param marker: File or directory which exists in the root of repositories of this type
+    :param tag: Short name of the vcs (defaults to the marker without the leading dot)
+    """
+
+    def __init__(self, path, marker, tag=None):
+        self.path = path
+        self.marker = marker
+        self.TAG = tag or marker.lstrip('.')
+
+    def detect(self, project_root, **init_kwargs):
+        if not os.path.exists(os.path.join(project_root, self.marker)):
+            return False
+
+        return self.load().detect(project_root, **init_kwargs)
+
+    def load(self):
+        module_name, _, name = self.path.rpartition('.')
+
+        return getattr(importlib.import_module(module_name), name)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyHandler):
+            return self.path == other.path
+
+        return isinstance(other, type) and '%s.%s' % (other.__module__, other.__name__) == self.path
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
 
 
 class VcsProxy(object):
+    """ Placeholder returned by Vcs.init which turns into the detected vcs handler on first use
+
+        The vcs type is detected lazily (on first attribute access), after which the proxy replaces its class and
+        state with the ones of the handler, so later attribute access goes straight to the handler.
+    """
+
     VCS_HANDLERS = [
-        Mercurial,
-        Git
+        LazyHandler('hammer.vcs.hg.Mercurial', '.hg'),
+        LazyHandler('hammer.vcs.git.Git', '.git'),
     ]
 
-    def __init__(self, project_root, **init_kwargs):
+    def __init__(self, project_root, search_parents=False, **init_kwargs):
         self._data = {
             'project_root': project_root,
+            'search_parents': search_parents,
             'init_kwargs': init_kwargs,
         }
 
-        self._real = 'VcsProxy'
-
     @classmethod
     def init(cls, project_root, **init_kwargs):
         """ Detect the vcs type the project uses and initialize
             the correct handler to use internally.
 
             :param project_root: Root directory of project
+            :param search_parents: Also look for the repository in parent directories of project_root
             :rtype: hammer.vcs.base.BaseVcs
         """
 
         return VcsProxy(project_root=project_root, **init_kwargs)
 
     @classmethod
-    def detect(cls, project_root, **init_kwargs):
-        for handler_cls in cls.VCS_HANDLERS:
-            res = handler_cls.detect(project_root, **init_kwargs)
+    def resolve(cls, project_root, search_parents=False, **init_kwargs):
+        """ Detect the vcs type the project uses right away and return the handler itself (instead of a proxy)
+
+            :param project_root: Root directory of project
+            :param search_parents: Also look for the repository in parent directories of project_root
+            :rtype: hammer.vcs.base.BaseVcs
+        """
+        handler_cls = cls.detect(project_root, search_parents=search_parents, **init_kwargs)
+
+        return handler_cls(project_root=project_root, **init_kwargs)
+
+    @classmethod
+    def register_handler(cls, handler_cls, first=False):
+        """ Add a vcs handler (BaseVcs subclass or LazyHandler) to the ones used for detection
 
-            # Found a match
-            if res:
-                return handler_cls
+            :param first: Try the handler before the already registered ones
+        """
+        cls.unregister_handler(handler_cls)
+
+        if first:
+            cls.VCS_HANDLERS.insert(0, handler_cls)
+
+        else:
+            cls.VCS_HANDLERS.append(handler_cls)
+
+    @classmethod
+    def unregister_handler(cls, handler_cls):
+        if handler_cls in cls.VCS_HANDLERS:
+            cls.VCS_HANDLERS.remove(handler_cls)
+
+        cls.clear_detect_cache()
+
+    @staticmethod
+    def clear_detect_cache():
+        _detect_cache.clear()
+
+    @classmethod
+    def detect(cls, project_root, search_parents=False, **init_kwargs):
+        """ Find the handler for the repository at project_root
+
+            Successful detections are cached per (absolute) project root, so creating many proxies for the same
+            project only checks the filesystem once.
+
+            :param search_parents: Also look for the repository in parent directories of project_root (the
+                                   closest one wins)
+            :rtype: type
+        """
+        path = os.path.abspath(project_root)
+        key = (cls, path, search_parents)
+
+        if key in _detect_cache:
+            return _detect_cache[key]
+
+        visited = []
+
+        while True:
+            visited.append(path)
+
+            for handler_cls in cls.VCS_HANDLERS:
+                res = handler_cls.detect(path, **init_kwargs)
+
+                # Found a match
+                if res:
+                    if isinstance(handler_cls, LazyHandler):
+                        handler_cls = handler_cls.load()
+
+                    # Directories between project_root and the repository root resolve to the same handler
+                    for visited_path in visited:
+                        _detect_cache[(cls, visited_path, search_parents)] = handler_cls
+
+                    return handler_cls
+
+            parent = os.path.dirname(path)
+
+            # Continue from a parent whose repository is already known
+            if search_parents and (cls, parent, True) in _detect_cache:
+                for visited_path in visited:
+                    _detect_cache[(cls, visited_path, True)] = _detect_cache[(cls, parent, True)]
+
+                return _detect_cache[(cls, parent, True)]
+
+            if not search_parents or parent == path:
+                break
+
+            path = parent
 
         handlers = ', '.join([x.TAG for x in cls.VCS_HANDLERS])
         raise EnvironmentError('No suitable VCS type detected (tried %s)' % handlers)
@@ -43,24 +170,32 @@ class VcsProxy(object):
     # Proxy logic
     # ============
 
-    def __getattribute__(self, name):
-        real = object.__getattribute__(self, "_real")
+    def _become_real(self):
+        data = self._data
+        real = VcsProxy.resolve(data['project_root'], search_parents=data['search_parents'], **data['init_kwargs'])
+
+        # Attributes set on the proxy before it was resolved
+        state = dict(self.__dict__)
+        del state['_data']
 
-        if real == 'VcsProxy':
-            data = object.__getattribute__(self, "_data")
+        real.__dict__.update(state)
+        real._real = real
 
-            cls = VcsProxy.detect(project_root=data['project_root'], **data['init_kwargs'])
-            real = cls(project_root=data['project_root'], **data['init_kwargs'])
+        # Turn into the handler: both objects share the same state from now on
+        self.__class__ = real.__class__
+        self.__dict__ = real.__dict__
 
-            self._real = real
+    def __getattr__(self, name):
+        # Only called for attributes the proxy does not have, e.g. everything until the proxy is resolved
+        if name == '_data':
+            raise AttributeError(name)
 
-        if name == '_real':
-            return real
+        self._become_real()
 
-        return getattr(real, name)
+        return getattr(self, name)
 
     def __str__(self):  # pragma: no cover
-        return str(object.__getattribute__(self, "_real"))
+        return 'VcsProxy'
 
     def __repr__(self):  # pragma: no cover
-        return repr(object.__getattribute__(self, "_real"))
+        return "'VcsProxy'"
@@ -212,6 +212,18 @@ class VcsTestUtil(object):
 def pytest_addoption(parser):
     parser.addoption('--hg', action='store_true', help='Test hg integration only')
     parser.addoption('--git', action='store_true', help='Test git integration only')
+    parser.addoption('--benchmark', action='store_true', help='Run benchmarks (tests marked with benchmark)')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('benchmark'):
+        return
+
+    skip = pytest.mark.skip(reason='Benchmarks only run with --benchmark')
+
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
 
 
 def pytest_generate_tests(metafunc):
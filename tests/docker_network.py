@@ -1,9 +1,14 @@
 from __future__ import unicode_literals
 
+import re
+from collections import OrderedDict
+from subprocess import CalledProcessError
+
 import pytest
 
-from hammer.docker_network import DockerNetworkAllocator, OutOfNetworks
-from hammer.docker_network import local_cmd, create_docker_network
+from hammer.docker_network import DockerNetworkAllocator, NetworkIndex, NetworkSnapshot, OutOfNetworks
+from hammer.docker_network import local_cmd, make_network, create_docker_network, remove_stale_docker_networks
+from hammer.docker_network import acquire_docker_network, fill_docker_network_pool, release_docker_network
 from ipaddress import IPv4Network
 
 
@@ -93,3 +98,481 @@ def test_plenty_of_networks():
         assert assigned not in used_networks
 
         used_networks.add(assigned)
+
+
+def test_assign_reserves_network():
+    allocator = fake_allocator()
+
+    first = allocator.assign(prefix=24)
+    second = allocator.assign(prefix=26)
+
+    assert not first.overlaps(second)
+
+    networks = allocator.assign_many(64)
+    assert len(set(networks)) == 64
+    assert not any(first.overlaps(x) or second.overlaps(x) for x in networks)
+
+    # refresh forgets the networks assigned by this allocator
+    allocator.refresh()
+    assert allocator.assign(prefix=24) == first
+
+
+def test_network_index_skips_used_ranges():
+    index = NetworkIndex([IPv4Network('10.0.0.0/16')], [
+        IPv4Network('10.0.0.0/24'),
+        IPv4Network('10.0.1.0/25'),
+        IPv4Network('10.0.2.0/23'),
+    ])
+
+    # Adjacent ranges are merged
+    assert index.used_ranges() == [
+        (int(IPv4Network('10.0.0.0/24').network_address), int(IPv4Network('10.0.1.127/32').network_address)),
+        (int(IPv4Network('10.0.2.0/23').network_address), int(IPv4Network('10.0.3.255/32').network_address)),
+    ]
+
+    assert index.find(25) == IPv4Network('10.0.1.128/25')
+    assert index.find(24) == IPv4Network('10.0.4.0/24')
+    assert index.find(22) == IPv4Network('10.0.4.0/22')
+    assert index.find(15) is None
+
+    assert not index.is_free(IPv4Network('10.0.3.0/24'))
+    assert index.is_free(IPv4Network('10.0.4.0/24'))
+
+
+def test_network_index_continues_search():
+    index = NetworkIndex([IPv4Network('10.0.0.0/23'), IPv4Network('10.1.0.0/24')], [IPv4Network('10.0.0.64/26')])
+
+    assert index.find(26) == IPv4Network('10.0.0.0/26')
+    index.reserve(IPv4Network('10.0.0.0/26'))
+
+    assert index.find(26) == IPv4Network('10.0.0.128/26')
+    assert index.find(24) == IPv4Network('10.0.1.0/24')
+    index.reserve(IPv4Network('10.0.1.0/24'))
+
+    # The first pool is full for /24, the search continues in the next one
+    assert index.find(24) == IPv4Network('10.1.0.0/24')
+    assert index.find(26) == IPv4Network('10.0.0.128/26')
+
+    index.reserve(IPv4Network('10.1.0.0/24'))
+    assert index.find(24) is None
+    assert index.find(24) is None
+
+
+def test_assign_with_many_used_networks():
+    # Every other /24 of 10.0.0.0/10 is in use
+    used_networks = [make_network(int(IPv4Network('10.0.0.0/8').network_address) + i * 512, 24) for i in range(8192)]
+    allocator = fake_allocator(used_networks)
+
+    assert allocator.assign(prefix=24) == IPv4Network('10.0.1.0/24')
+    assert allocator.assign(prefix=23) == IPv4Network('10.64.0.0/23')
+
+
+def test_create_many():
+    commands = []
+
+    def recording_cmd(cmd, context=None):
+        commands.append(cmd)
+
+        if cmd.startswith('echo'):
+            return b'#tg-hammer:docker\nexisting [{"Subnet":"10.0.0.0/24"}]\n'
+
+        return b''
+
+    allocator = DockerNetworkAllocator(recording_cmd, reservation_dir=None)
+
+    result = allocator.create_many(['ci_1', 'existing', 'ci_2', 'ci_1'], internal=True)
+
+    assert list(result.keys()) == ['ci_1', 'existing', 'ci_2']
+    assert result['existing'] is None
+    assert result['ci_1'] == IPv4Network('10.0.1.0/24')
+    assert result['ci_2'] == IPv4Network('10.0.2.0/24')
+
+    # One call to read the networks in use and one to create all of them
+    assert len(commands) == 2
+    labels = '--label tg-hammer.allocator --label tg-hammer.created=$(date +%s)'
+    assert commands[1] == ('docker network create --internal {0} --subnet 10.0.1.0/24 ci_1 && '
+                           'docker network create --internal {0} --subnet 10.0.2.0/24 ci_2').format(labels)
+
+    # Networks created by the allocator are remembered
+    assert not allocator.create('ci_2')
+    assert len(commands) == 2
+
+
+def test_create_retries_reservation_conflicts():
+    commands = []
+
+    def racing_cmd(cmd, context=None):
+        commands.append(cmd)
+
+        if cmd.startswith('echo'):
+            # Another job has reserved a subnet but not created its network yet
+            return b'#tg-hammer:reserved\n10.0.0.0_24\n'
+
+        if '10.0.2.0_24' in cmd:
+            # ... and another one reserved 10.0.2.0/24 after we read the reservations
+            return b'tg-hammer-reservation-conflict: 10.0.2.0_24\n'
+
+        return b''
+
+    allocator = DockerNetworkAllocator(racing_cmd, reservation_dir='/tmp/reservations')
+
+    result = allocator.create_many(['ci_1', 'ci_2'])
+
+    assert result['ci_1'] == IPv4Network('10.0.1.0/24')
+    assert result['ci_2'] == IPv4Network('10.0.3.0/24')
+
+    # Reservations are read once (with the rest of the snapshot), only the conflicting network is retried
+    # with the next free subnet
+    assert len(commands) == 3
+    assert "mkdir '10.0.1.0_24'" in commands[1] and '--subnet 10.0.1.0/24 ci_1' in commands[1]
+    assert "mkdir '10.0.3.0_24'" in commands[2] and '--subnet 10.0.3.0/24 ci_2' in commands[2]
+    assert 'ci_1' not in commands[2]
+
+    assert not allocator.create('ci_1')
+
+
+def test_create_gives_up_after_max_attempts():
+    def always_conflicting_cmd(cmd, context=None):
+        if 'tg-hammer-reservation-conflict' in cmd:
+            return 'tg-hammer-reservation-conflict: {}\n'.format(' '.join(re.findall(r"mkdir '([^']+)'", cmd))).encode()
+
+        return b''
+
+    allocator = DockerNetworkAllocator(always_conflicting_cmd, max_attempts=3)
+    allocator._networks_in_use = lambda: []
+
+    with pytest.raises(OutOfNetworks):
+        allocator.create('ci_1')
+
+    # Every attempt used a new subnet
+    assert allocator.assign() == IPv4Network('10.0.4.0/24')
+
+
+def test_create_after_other_job_created():
+    # Host shared by two jobs, reservations are kept after the networks are created
+    networks = {}
+    reserved = set()
+
+    def host_cmd(cmd, context=None):
+        if cmd.startswith('echo'):
+            return '#tg-hammer:docker\n{}\n#tg-hammer:reserved\n{}\n'.format(
+                '\n'.join('{} [{{"Subnet":"{}"}}]'.format(name, subnet) for name, subnet in networks.items()),
+                '\n'.join(reserved)).encode()
+
+        conflicts, overlaps = [], []
+
+        for subnet, name in re.findall(r'--subnet (\S+) (\S+)', cmd):
+            subnet = IPv4Network(subnet)
+            reservation = subnet.exploded.replace('/', '_')
+
+            if reservation in reserved:
+                conflicts.append(reservation)
+
+            elif any(subnet.overlaps(IPv4Network(x)) for x in networks.values()):
+                overlaps.append(reservation)
+
+            else:
+                reserved.add(reservation)
+                networks[name] = subnet.exploded
+
+        return 'tg-hammer-reservation-conflict: {}\ntg-hammer-network-overlap: {}\n'.format(
+            ' '.join(conflicts), ' '.join(overlaps)).encode()
+
+    # Both jobs read the host before job A creates its networks
+    job_a = DockerNetworkAllocator(host_cmd)
+    job_b = DockerNetworkAllocator(host_cmd)
+    job_a.existing_networks()
+    job_b.existing_networks()
+
+    assert job_a.create_many(['a_1', 'a_2'])['a_2'] == IPv4Network('10.0.1.0/24')
+
+    # Job B tries the same subnets after job A has finished, the reservations are still there
+    result = job_b.create_many(['b_1', 'b_2'])
+    assert list(result.values()) == [IPv4Network('10.0.2.0/24'), IPv4Network('10.0.3.0/24')]
+
+    # Different prefix: the reservation does not conflict, but docker refuses the overlapping subnet
+    job_c = DockerNetworkAllocator(host_cmd)
+    job_c.existing_networks()
+    networks['other'] = '10.0.4.0/24'
+
+    assert job_c.create_many(['c_1'], prefix=26)['c_1'] == IPv4Network('10.0.5.0/26')
+    assert networks['c_1'] == '10.0.5.0/26'
+
+
+def test_network_snapshot_json():
+    snapshot = NetworkSnapshot.parse(
+        '#tg-hammer:addr\n'
+        '[{"ifname":"lo","addr_info":[{"family":"inet","local":"127.0.0.1","prefixlen":8}]},'
+        '{"ifname":"docker0","addr_info":[{"family":"inet","local":"172.17.0.1","prefixlen":16}]}]\n'
+        '#tg-hammer:route\n'
+        '[{"dst":"default","gateway":"192.0.2.1"},{"dst":"192.0.2.0/24"},{"dst":"172.17.0.0/16"}]\n'
+        '#tg-hammer:docker\n'
+        'bridge [{"Subnet":"172.17.0.0/16","Gateway":"172.17.0.1"}]\n'
+        'host []\n'
+        'none null\n'
+        'ci_1 [{"Subnet":"10.0.0.0/24"},{"Subnet":"fd00::/64"}]\n'
+        '#tg-hammer:reserved\n'
+        '10.0.1.0_24\n'
+        'lost+found\n'
+    )
+
+    assert snapshot.interfaces == [IPv4Network('127.0.0.0/8'), IPv4Network('172.17.0.0/16')]
+    assert snapshot.routes == [IPv4Network('192.0.2.0/24'), IPv4Network('172.17.0.0/16')]
+    assert list(snapshot.docker_networks.keys()) == ['bridge', 'host', 'none', 'ci_1']
+    assert snapshot.docker_networks['ci_1'] == [IPv4Network('10.0.0.0/24')]
+    # Anything else in the registry is ignored
+    assert snapshot.reserved == [IPv4Network('10.0.1.0/24')]
+
+    # Subnets of docker networks are used even if they have no route (yet)
+    assert IPv4Network('10.0.0.0/24') in set(snapshot.used_networks())
+
+
+def test_network_snapshot_text_fallback():
+    snapshot = NetworkSnapshot.parse(
+        '#tg-hammer:addr\n127.0.0.1/8\n10.0.0.5/24\n'
+        '#tg-hammer:route\n10.0.0.0/24\n10.8.0.0/16\n'
+        '#tg-hammer:docker\n'
+    )
+
+    assert snapshot.interfaces == [IPv4Network('127.0.0.0/8'), IPv4Network('10.0.0.0/24')]
+    assert snapshot.routes == [IPv4Network('10.0.0.0/24'), IPv4Network('10.8.0.0/16')]
+    assert not snapshot.docker_networks
+    assert not snapshot.reserved
+
+
+def test_network_snapshot_failed_section():
+    # Fallback of `ip -j` is fine
+    snapshot = NetworkSnapshot.parse(
+        '#tg-hammer:addr\n127.0.0.1/8\n#tg-hammer:rc 0\n'
+        '#tg-hammer:docker\nci_1 [{"Subnet":"10.0.0.0/24"}]\n#tg-hammer:rc 0\n'
+    )
+    assert list(snapshot.docker_networks.keys()) == ['ci_1']
+
+    # ... but a failed section must not look like a host without networks
+    with pytest.raises(CalledProcessError) as exc_info:
+        NetworkSnapshot.parse('#tg-hammer:addr\n127.0.0.1/8\n#tg-hammer:rc 0\n#tg-hammer:docker\n#tg-hammer:rc 1\n')
+
+    assert exc_info.value.returncode == 1
+    assert exc_info.value.cmd.startswith('names=$(docker network ls -q)')
+
+    def failing_docker_cmd(cmd, context=None):
+        return b'#tg-hammer:route\n10.0.0.0/24\n#tg-hammer:rc 0\n#tg-hammer:docker\n#tg-hammer:rc 127\n'
+
+    with pytest.raises(CalledProcessError):
+        DockerNetworkAllocator(failing_docker_cmd).assign()
+
+
+def test_snapshot_is_reused():
+    commands = []
+
+    def recording_cmd(cmd, context=None):
+        commands.append(cmd)
+
+        if cmd.startswith('echo'):
+            return b'#tg-hammer:route\n10.0.0.0/24\n#tg-hammer:docker\nci_1 [{"Subnet":"10.0.1.0/24"}]\n'
+
+        return b''
+
+    allocator = DockerNetworkAllocator(recording_cmd)
+
+    assert allocator.assign_many(2) == [IPv4Network('10.0.2.0/24'), IPv4Network('10.0.3.0/24')]
+    assert not allocator.create('ci_1')
+    assert allocator.create('ci_2')
+
+    assert len(commands) == 2
+    assert commands[0] == NetworkSnapshot.command(allocator.reservation_dir, allocator.warm_pool_dir)
+
+
+def test_remove_stale_networks():
+    commands = []
+
+    def recording_cmd(cmd, context=None):
+        commands.append(cmd)
+
+        if cmd.startswith('date'):
+            return (
+                b'100000\n'
+                b'old_unused 10000 0\n'
+                b'old_used 10000 2\n'
+                b'new_unused 99000 0\n'
+                b'old_busy 10000 0\n'
+                b'unknown <no value> 0\n'
+                b'tg-hammer-pool-0123 10000 0\n'
+                b'tg-hammer-pool-4567 10000 0\n'
+                b'tg-hammer-pool-89ab 10000 0\n'
+                b'tg-hammer-pool-cdef 10000 1\n'
+                b'#tg-hammer-claim tg-hammer-pool-4567 10000\n'
+                b'#tg-hammer-claim tg-hammer-pool-89ab 99000\n'
+                b'#tg-hammer-claim tg-hammer-pool-cdef 10000\n'
+            )
+
+        if cmd.startswith('docker'):
+            # old_busy got a container after it was listed
+            return b'old_unused\ntg-hammer-pool-4567\n'
+
+        return b''
+
+    removed = remove_stale_docker_networks(ttl=3600, cmd=recording_cmd)
+
+    # Idle and recently claimed pool networks are kept, the ones claimed long ago (without containers) are removed
+    assert removed == ['old_unused', 'tg-hammer-pool-4567']
+    assert len(commands) == 3
+    assert "--filter 'label=tg-hammer.allocator'" in commands[0]
+    assert "find '/run/tg-hammer/docker-network-pool'" in commands[0]
+    assert commands[1] == "docker network rm 'old_unused' 'old_busy' 'tg-hammer-pool-4567' 2>/dev/null; true"
+    assert commands[2] == 'rmdir /run/tg-hammer/docker-network-pool/tg-hammer-pool-4567'
+
+    # Nothing to remove
+    assert DockerNetworkAllocator(lambda cmd, context=None: b'100000\n').remove_stale() == []
+
+
+def test_warm_pool():
+    commands = []
+    claimed = set()
+    internal_24 = {'tg-hammer.pool', 'tg-hammer.pool.internal=true', 'tg-hammer.pool.prefix=24'}
+    networks = OrderedDict([
+        ('tg-hammer-pool-a', internal_24),
+        ('tg-hammer-pool-b', internal_24),
+        ('tg-hammer-pool-c', {'tg-hammer.pool', 'tg-hammer.pool.internal=false', 'tg-hammer.pool.prefix=24'}),
+        ('ci_1', set()),
+    ])
+
+    def pool_networks(cmd):
+        filters = set(re.findall(r"'label=([^']+)'", cmd))
+        return [name for name, labels in networks.items() if filters and filters <= labels]
+
+    def host_cmd(cmd, context=None):
+        commands.append(cmd)
+
+        if cmd.startswith('echo'):
+            return '#tg-hammer:docker\n{}\n#tg-hammer:claimed\n{}\n'.format(
+                '\n'.join('{} []'.format(x) for x in networks), '\n'.join(claimed)).encode()
+
+        if 'for n in $(docker network ls' in cmd:
+            for name in pool_networks(cmd):
+                if name not in claimed:
+                    claimed.add(name)
+                    return name.encode() + b'\n'
+
+            return b''
+
+        if cmd.startswith("'docker' 'network' 'ls'"):
+            return '\n'.join(pool_networks(cmd)).encode()
+
+        if cmd.startswith('(cd '):
+            # New pool network, claimed in the same command before it is created
+            claimed.update(re.findall(r"'([^']+)'", cmd.split(')')[0].split('mkdir -p ')[-1]))
+            assert 'docker network create' in cmd.split(')')[1]
+
+        elif cmd.startswith('rmdir'):
+            claimed.discard(cmd.split('/')[-1].strip("'"))
+
+        for create in cmd.split('docker network create')[1:]:
+            labels = set(re.findall(r'--label (\S+)', create.split(' 2>&1')[0]))
+            networks[create.split(' 2>&1')[0].split()[-1]] = labels
+
+        return b''
+
+    # Two idle internal networks, one more is created
+    created = fill_docker_network_pool(3, cmd=host_cmd)
+    assert len(created) == 1 and created[0].startswith('tg-hammer-pool-')
+    assert '--internal' in commands[-1] and '--label tg-hammer.pool --label tg-hammer.pool.internal=true' in commands[-1]
+    assert internal_24 <= networks[created[0]]
+
+    # Taking a network is a single command
+    del commands[:]
+    assert acquire_docker_network(cmd=host_cmd) == 'tg-hammer-pool-a'
+    assert acquire_docker_network(cmd=host_cmd) == 'tg-hammer-pool-b'
+    assert len(commands) == 2
+
+    # Only networks with the same options are taken
+    assert acquire_docker_network(internal=False, cmd=host_cmd) == 'tg-hammer-pool-c'
+
+    release_docker_network('tg-hammer-pool-a', cmd=host_cmd)
+    assert commands[-1] == 'rmdir /run/tg-hammer/docker-network-pool/tg-hammer-pool-a'
+    assert acquire_docker_network(cmd=host_cmd) == 'tg-hammer-pool-a'
+
+    # Only names of pool networks are released
+    for name in ['ci_1', 'tg-hammer-pool-../../etc', "tg-hammer-pool-a'; reboot; '", 'tg-hammer-pool-a\n']:
+        with pytest.raises(ValueError):
+            release_docker_network(name, cmd=host_cmd)
+
+    allocator = DockerNetworkAllocator(host_cmd)
+    assert allocator.warm_pool_networks() == (created, ['tg-hammer-pool-a', 'tg-hammer-pool-b', 'tg-hammer-pool-c'])
+    assert allocator.warm_pool_networks(internal=False, prefix=24) == ([], ['tg-hammer-pool-c'])
+    assert allocator.fill_warm_pool(1) == []
+
+    # Empty pool: a new network is claimed and created with a single command
+    assert allocator.acquire_network() == created[0]
+    del commands[:]
+    name = allocator.acquire_network(prefix=26)
+    assert name.startswith('tg-hammer-pool-') and name in claimed
+    assert len(commands) == 2
+    assert "mkdir -p '{}'".format(name) in commands[1]
+    assert '--label tg-hammer.pool.prefix=26 --subnet' in commands[1] and '/26' in commands[1]
+
+
+def test_fill_warm_pool_background():
+    commands = []
+
+    def recording_cmd(cmd, context=None):
+        commands.append(cmd)
+        return b'#tg-hammer:docker\n' if cmd.startswith('echo') else b''
+
+    names = fill_docker_network_pool(2, cmd=recording_cmd, background=True)
+
+    # Snapshot, idle pool networks and the detached create command
+    assert len(commands) == 3
+    assert commands[2].startswith('setsid nohup sh -c ') and commands[2].endswith(' &')
+    assert all(name in commands[2] for name in names)
+    assert '--subnet 10.0.0.0/24' in commands[2] and '--subnet 10.0.1.0/24' in commands[2]
+
+
+def test_best_fit_policy():
+    used_networks = [
+        IPv4Network('10.0.1.0/24'),
+        IPv4Network('10.0.2.64/26'),
+        IPv4Network('10.0.2.128/25'),
+        IPv4Network('10.0.4.0/22'),
+    ]
+    pool = [IPv4Network('10.0.0.0/16')]
+
+    first_fit = fake_allocator(used_networks, pool=pool)
+    best_fit = fake_allocator(used_networks, pool=pool, policy='best-fit')
+
+    # Free: 10.0.0.0/24, 10.0.2.0/26, 10.0.3.0/24, 10.0.8.0/21, 10.0.16.0/20, ...
+    assert first_fit.assign(prefix=26) == IPv4Network('10.0.0.0/26')
+    assert best_fit.assign(prefix=26) == IPv4Network('10.0.2.0/26')
+
+    # First fit has broken up the first /24 hole and starts on the /21 one
+    assert first_fit.assign_many(2) == [IPv4Network('10.0.3.0/24'), IPv4Network('10.0.8.0/24')]
+    assert best_fit.assign_many(2) == [IPv4Network('10.0.0.0/24'), IPv4Network('10.0.3.0/24')]
+
+    assert first_fit.assign(prefix=21) == IPv4Network('10.0.16.0/21')
+    assert best_fit.assign(prefix=21) == IPv4Network('10.0.8.0/21')
+
+    with pytest.raises(ValueError):
+        fake_allocator(policy='worst-fit')
+
+
+def test_fragmentation_report():
+    allocator = fake_allocator([IPv4Network('10.0.0.64/26'), IPv4Network('10.0.1.0/24')], pool=[
+        IPv4Network('10.0.0.0/22'),
+        IPv4Network('10.1.0.0/24'),
+    ])
+    allocator.index.reserve(IPv4Network('10.1.0.0/24'))
+
+    assert allocator.fragmentation_report() == [
+        {
+            'network': IPv4Network('10.0.0.0/22'),
+            'free': 64 + 128 + 512,
+            'largest': IPv4Network('10.0.2.0/23'),
+            'blocks': {26: 1, 25: 1, 23: 1},
+        },
+        {
+            'network': IPv4Network('10.1.0.0/24'),
+            'free': 0,
+            'largest': None,
+            'blocks': {},
+        },
+    ]
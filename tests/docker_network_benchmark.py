@@ -0,0 +1,181 @@
+"""
+Benchmarks of DockerNetworkAllocator against synthetic host topologies
+
+The allocator gets a stubbed cmd which returns a host snapshot (see NetworkSnapshot) with
+the given number of used ranges, spread over interfaces, routes and docker networks.
+Each case reports the time it takes to parse the snapshot and build the index, the
+latency of assign and the memory used by the index.
+
+The timing assertions only use very loose limits, they are meant to catch changes which make
+the allocator scale badly (e.g. back to checking every subnet of the pool). Since timings depend
+on the machine, the benchmarks only run with `py.test --benchmark tests/docker_network_benchmark.py`,
+the default run only checks the size of the index.
+"""
+from __future__ import unicode_literals, print_function
+
+import gc
+import json
+import time
+from ipaddress import IPv4Network
+
+import pytest
+
+from hammer.docker_network import DockerNetworkAllocator, make_network
+
+
+tracemalloc = pytest.importorskip('tracemalloc')
+
+ASSIGN_COUNT = 200
+
+
+def synthetic_networks(count, prefix=26, stride=2):
+    """
+    Used networks spread over 10.0.0.0/8 and 172.16.0.0/12, every `stride`-th block of the prefix is used
+    """
+    bases = [IPv4Network('10.0.0.0/8'), IPv4Network('172.16.0.0/12')]
+    size = 2 ** (32 - prefix)
+    networks = []
+
+    for base in bases:
+        start = int(base.network_address)
+        blocks = base.num_addresses // size
+
+        for i in range(0, blocks, stride):
+            if len(networks) == count:
+                return networks
+
+            networks.append(make_network(start + i * size, prefix))
+
+    return networks
+
+
+def synthetic_snapshot(networks):
+    """
+    Output of NetworkSnapshot.command for a host using the given networks
+    """
+    addr, route, docker = networks[0::3], networks[1::3], networks[2::3]
+
+    return '\n'.join([
+        '#tg-hammer:addr',
+        json.dumps([
+            {'ifname': 'br-%d' % i, 'addr_info': [
+                {'family': 'inet', 'local': str(x.network_address + 1), 'prefixlen': x.prefixlen},
+            ]}
+            for i, x in enumerate(addr)
+        ]),
+        '#tg-hammer:route',
+        json.dumps([{'dst': 'default', 'gateway': '192.0.2.1'}] + [{'dst': x.exploded} for x in route]),
+        '#tg-hammer:docker',
+    ] + [
+        'net_%d %s' % (i, json.dumps([{'Subnet': x.exploded}])) for i, x in enumerate(docker)
+    ] + [
+        '#tg-hammer:reserved',
+    ]).encode('utf-8')
+
+
+def run_benchmark(used_count, prefix=24, pool=None, policy='first-fit', prefixes=None, report=True):
+    output = synthetic_snapshot(synthetic_networks(used_count))
+
+    def stub_cmd(cmd, context=None):
+        return output if cmd.startswith('echo') else b''
+
+    started = time.time()
+    allocator = DockerNetworkAllocator(stub_cmd, pool=pool, policy=policy)
+    snapshot = allocator.snapshot
+    parse_time = time.time() - started
+
+    # Memory of the index (the snapshot is kept by the allocator as well, but does not change with allocations)
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        started = time.time()
+        ranges = len(allocator.index.used_ranges())
+        build_time = time.time() - started
+
+        latencies = []
+
+        for i in range(ASSIGN_COUNT):
+            started = time.time()
+            allocator.assign(prefix=prefixes[i % len(prefixes)] if prefixes else prefix)
+            latencies.append(time.time() - started)
+
+        memory, peak = tracemalloc.get_traced_memory()
+
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+
+    # Largest free block of the first pool network
+    largest = allocator.fragmentation_report()[0]['largest']
+
+    result = {
+        'used': len(list(snapshot.used_networks())),
+        'policy': policy,
+        'prefix': '/'.join(str(x) for x in prefixes) if prefixes else prefix,
+        'ranges': ranges,
+        'parse_ms': parse_time * 1000,
+        'build_ms': build_time * 1000,
+        'assign_median_us': latencies[len(latencies) // 2] * 1000000,
+        'assign_max_us': latencies[-1] * 1000000,
+        'memory_kb': memory / 1024.0,
+        'peak_kb': peak / 1024.0,
+        'largest': largest.prefixlen if largest is not None else None,
+    }
+
+    if report:
+        print(
+            '\nassign benchmark: {used} used networks ({ranges} ranges), {policy} /{prefix}: parse {parse_ms:.1f}ms, '
+            'build {build_ms:.1f}ms, assign median {assign_median_us:.1f}us (max {assign_max_us:.1f}us), '
+            'index memory {memory_kb:.0f}KB (peak {peak_kb:.0f}KB), largest free block /{largest}'.format(**result))
+
+    return result
+
+
+@pytest.mark.parametrize('used_count', [10, 1000])
+def test_index_size(used_count):
+    result = run_benchmark(used_count, report=False)
+
+    # Nothing touches, so every used network is a range of its own
+    assert result['used'] == used_count
+    assert result['ranges'] == used_count
+
+    # The index keeps two integers per range and a few free blocks per free range
+    assert result['memory_kb'] < 64 + used_count * 0.5
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('used_count', [10, 1000, 50000])
+@pytest.mark.parametrize('prefix', [24, 28])
+def test_assign_benchmark(used_count, prefix):
+    result = run_benchmark(used_count, prefix=prefix)
+
+    assert result['ranges'] == used_count
+    assert result['memory_kb'] < 64 + used_count * 0.5
+
+    # Assign looks up the free block lists instead of skipping every used range
+    assert result['assign_median_us'] < 1000
+
+
+@pytest.mark.benchmark
+def test_assign_benchmark_small_pool():
+    # Pool much smaller than the used networks: most of the snapshot is outside of it
+    result = run_benchmark(50000, pool=[IPv4Network('172.16.0.0/16')])
+
+    assert result['assign_median_us'] < 1000
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('used_count', [10, 1000, 50000])
+def test_mixed_prefix_benchmark(used_count):
+    prefixes = [24, 26, 20, 26, 24, 26]
+
+    first_fit = run_benchmark(used_count, prefixes=prefixes)
+    best_fit = run_benchmark(used_count, prefixes=prefixes, policy='best-fit')
+
+    # Best fit takes the first block of the free block lists instead of scanning all free blocks
+    assert best_fit['assign_median_us'] < 1000
+
+    # ... and keeps at least as large blocks free as first fit
+    assert best_fit['largest'] <= first_fit['largest']
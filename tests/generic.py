@@ -1,8 +1,16 @@
 import os
+import re
+import subprocess
+import sys
+import time
+
 import pytest
 
-from hammer.vcs import BaseVcs, Vcs
-from hammer.util import is_fabric1
+from hammer.vcs import BaseVcs, BranchCache, ChangeSet, FileChange, LazyHandler, Vcs, VcsGroup
+from hammer.vcs.changes import compile_filter, filter_changes, iter_lines
+from hammer.vcs.git import Git
+from hammer.vcs.local import git_remotes, parse_git_remotes, parse_hg_paths
+from hammer.util import as_str, is_fabric1, shell_quote, UnexpectedExit
 
 
 @pytest.mark.skipif(not is_fabric1, reason='env is only available on fabric 1')
@@ -83,3 +91,624 @@ def test_invalid_vcs_raises_env_error():
 
     with pytest.raises(EnvironmentError):
         print(v.NAME)
+
+
+def test_proxy_becomes_handler(tmpdir):
+    tmpdir.mkdir('.git')
+
+    v = Vcs.init(str(tmpdir), code_dir='hello', use_sudo=False)
+    v.fetch_ttl = 30
+
+    assert type(v).__name__ == 'VcsProxy'
+    assert v.NAME == 'Git'
+
+    # After detection the proxy is the handler itself
+    assert type(v) is Git
+    assert v.fetch_ttl == 30
+    assert v.code_dir == 'hello'
+
+    # _real shares the state of the proxy
+    v._real.code_dir_marker = 'shared'
+    assert v.code_dir_marker == 'shared'
+
+    resolved = Vcs.resolve(str(tmpdir), code_dir='hello', use_sudo=False)
+    assert type(resolved) is Git
+
+
+def test_vcs_detection_searches_parents_and_is_cached(tmpdir, monkeypatch):
+    tmpdir.mkdir('.git')
+    project_root = str(tmpdir.mkdir('src').mkdir('project'))
+
+    with pytest.raises(EnvironmentError):
+        Vcs.detect(project_root)
+
+    assert Vcs.detect(project_root, search_parents=True) is Git
+    assert Vcs.init(project_root, search_parents=True, code_dir='hello', use_sudo=False).NAME == 'Git'
+
+    # Later detections don't touch the filesystem
+    monkeypatch.setattr(Vcs, 'VCS_HANDLERS', [])
+    assert Vcs.detect(project_root, search_parents=True) is Git
+    assert Vcs.detect(os.path.dirname(project_root), search_parents=True) is Git
+
+
+def test_vcs_register_handler(tmpdir):
+    class Fossil(BaseVcs):
+        TAG = 'fossil'
+        NAME = 'Fossil'
+
+        @classmethod
+        def detect(cls, project_root, **init_kwargs):
+            return os.path.exists(os.path.join(project_root, '.fslckout'))
+
+    tmpdir.join('.fslckout').write('')
+
+    Vcs.register_handler(Fossil)
+
+    try:
+        assert Vcs.resolve(str(tmpdir), code_dir='hello', use_sudo=False).NAME == 'Fossil'
+
+    finally:
+        Vcs.unregister_handler(Fossil)
+
+    with pytest.raises(EnvironmentError):
+        Vcs.detect(str(tmpdir))
+
+
+def test_vcs_register_lazy_handler(tmpdir):
+    tmpdir.join('.fake').write('')
+    handler = LazyHandler('tests.generic.LocalVcs', '.fake')
+
+    Vcs.register_handler(handler, first=True)
+
+    try:
+        assert type(Vcs.resolve(str(tmpdir), code_dir='hello', use_sudo=False)) is LocalVcs
+
+        # Handler classes and their lazy specs are interchangeable
+        assert LocalVcs in Vcs.VCS_HANDLERS
+
+        # The marker alone is not enough, the handler's own detect decides
+        tmpdir.mkdir('other').mkdir('.fake')
+
+        with pytest.raises(EnvironmentError):
+            Vcs.detect(str(tmpdir.join('other')))
+
+    finally:
+        Vcs.unregister_handler(LocalVcs)
+
+    assert handler not in Vcs.VCS_HANDLERS
+
+
+def test_import_does_not_load_backends():
+    # Guards `import hammer.vcs` startup time: backends, ftfy and fabric are only imported when needed
+    code = 'import sys; import hammer.vcs; print(" ".join(sys.modules))'
+    output = as_str(subprocess.check_output([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__))))
+
+    loaded = set(output.split())
+
+    for name in ['hammer.vcs.git', 'hammer.vcs.hg', 'ftfy', 'fabric', 'paramiko', 'colors']:
+        assert name not in loaded, '%s imported by hammer.vcs' % name
+
+
+def test_shell_quote():
+    assert shell_quote('refs/heads/master') == 'refs/heads/master'
+    assert shell_quote('') == "''"
+    assert shell_quote('foo bar') == "'foo bar'"
+    assert shell_quote("it's") == "'it'\"'\"'s'"
+
+
+def test_branch_cache_persists(tmpdir):
+    path = str(tmpdir.join('branches.json'))
+
+    cache = BranchCache(path)
+    cache.validate('repo', {'master': 'm1', 'stable': 's1'})
+    cache.update('repo', {'a' * 40: 'master', 'b' * 40: 'stable'})
+
+    # Another instance should see the same entries
+    other = BranchCache(path)
+    assert other.get('repo', 'a' * 40) == 'master'
+    assert other.get('repo', 'b' * 40) == 'stable'
+    assert other.get('other-repo', 'a' * 40) is None
+
+
+def test_branch_cache_lru_eviction(tmpdir):
+    cache = BranchCache(str(tmpdir.join('branches.json')), max_entries=2)
+
+    cache.set('repo', 'a', 'master')
+    cache.set('repo', 'b', 'master')
+
+    # Mark `a` as recently used so `b` is evicted
+    assert cache.get('repo', 'a') == 'master'
+    cache.set('repo', 'c', 'master')
+
+    assert len(cache) == 2
+    assert cache.get('repo', 'a') == 'master'
+    assert cache.get('repo', 'b') is None
+
+
+def test_branch_cache_invalidated_when_refs_move(tmpdir):
+    cache = BranchCache(str(tmpdir.join('branches.json')))
+
+    tips = {'master': 'm1', 'feature': 'f1', 'other': 'o1'}
+    cache.validate('repo', tips)
+    cache.update('repo', {'a': 'master', 'b': 'feature', 'c': 'other'}, tips=tips)
+    cache.set('other-repo', 'a', 'master', tips={'master': 'x1'})
+
+    # Pushes to other branches don't affect the cached entries
+    cache.validate('repo', dict(tips, other='o2'), is_fast_forward=lambda moved: moved.keys())
+    assert cache.get('repo', 'a') == 'master'
+    assert cache.get('repo', 'c') == 'other'
+
+    fast_forward_checks = []
+
+    def is_fast_forward(moved):
+        fast_forward_checks.append(dict(moved))
+        return [branch for branch in moved if branch != 'feature']
+
+    # master got new commits, feature was force-pushed and other was deleted
+    cache.validate('repo', {'master': 'm2', 'feature': 'f2'}, is_fast_forward=is_fast_forward)
+    assert fast_forward_checks == [{'master': ('m1', 'm2'), 'feature': ('f1', 'f2')}]
+
+    assert cache.get('repo', 'a') == 'master'
+    assert cache.get('repo', 'b') is None
+    assert cache.get('repo', 'c') is None
+    assert cache.get('other-repo', 'a') == 'master'
+
+    # The new tip is remembered, so nothing is checked when the refs don't move
+    cache.validate('repo', {'master': 'm2', 'feature': 'f2'}, is_fast_forward=is_fast_forward)
+    assert len(fast_forward_checks) == 1
+
+    # Other instances see the remembered tips as well, moved branches are dropped without a fast-forward check
+    other = BranchCache(cache.path)
+    other.validate('repo', {'master': 'm3'})
+    assert other.get('repo', 'a') is None
+
+
+@pytest.mark.skipif(is_fabric1, reason='VcsGroup is only supported on fabric 2')
+def test_vcs_group_runs_concurrently():
+    from fabric import Connection
+
+    group = VcsGroup('.', [Connection('app1.hammer'), Connection('app2.hammer'), Connection('app3.hammer')], code_dir='hello', use_sudo=False)
+
+    def fake_version(host):
+        def version():
+            time.sleep(0.2)
+
+            if host == 'app3.hammer':
+                raise EnvironmentError('Host is down')
+
+            return host
+
+        return version
+
+    for host, vcs in group.members.items():
+        vcs._real.version = fake_version(host)
+
+    result = group.version()
+
+    assert result == {'app1.hammer': 'app1.hammer', 'app2.hammer': 'app2.hammer'}
+    assert list(result.failed.keys()) == ['app3.hammer']
+    assert not result.ok
+
+    assert result.elapsed < result.sequential_elapsed
+    assert result.saved > 0.2
+
+
+@pytest.mark.skipif(is_fabric1, reason='VcsGroup is only supported on fabric 2')
+def test_vcs_group_rejects_duplicate_hosts():
+    from fabric import Connection
+
+    with pytest.raises(ValueError):
+        VcsGroup('.', [Connection('app1.hammer'), Connection('deploy@app1.hammer')], code_dir='hello', use_sudo=False)
+
+
+class LocalVcs(BaseVcs):
+    def remote_cmd(self, command, **kwargs):
+        return as_str(subprocess.check_output(['sh', '-c', command])).rstrip('\n')
+
+    @classmethod
+    def detect(cls, project_root, **init_kwargs):
+        return os.path.isfile(os.path.join(project_root, '.fake'))
+
+
+class LocalGit(Git):
+    def remote_cmd(self, command, **kwargs):
+        return as_str(subprocess.check_output(['sh', '-c', command], cwd=self.cmd_cwd_stack[-1])).rstrip('\n')
+
+
+def test_remote_batch():
+    vcs = LocalVcs('', code_dir='hello', use_sudo=False)
+
+    batch = vcs.batch()
+    multiline = batch.add('echo "hello"; echo "world"')
+    no_newline = batch.add("printf 'no newline'")
+    failing = batch.add('echo failing && exit 3')
+    skipped = batch.add('echo skipped')
+    batch.execute()
+
+    assert multiline.result() == 'hello\nworld'
+    assert no_newline.result() == 'no newline'
+
+    assert failing.exited == 3
+    assert failing.stdout == 'failing'
+
+    with pytest.raises(UnexpectedExit):
+        failing.result()
+
+    assert skipped.exited is None
+
+    with pytest.raises(RuntimeError):
+        skipped.result()
+
+
+def test_remote_batch_continue_on_error():
+    vcs = LocalVcs('', code_dir='hello', use_sudo=False)
+
+    batch = vcs.batch(stop_on_error=False)
+    failing = batch.add('false')
+    second = batch.add('cd / && pwd')
+    third = batch.add('echo "$PWD"')
+    batch.execute()
+
+    assert not failing.ok
+    assert second.result() == '/'
+
+    # Commands run in separate subshells
+    assert third.result() == os.getcwd()
+
+
+def test_remote_batch_prints_output_of_non_silent_commands(capsys):
+    vcs = LocalVcs('', code_dir='hello', use_sudo=False)
+
+    batch = vcs.batch()
+    batch.add('echo quiet')
+    loud = batch.add('echo loud', silent=False)
+    batch.execute()
+
+    assert loud.result() == 'loud'
+    assert capsys.readouterr().out == 'loud\n'
+
+
+def test_remote_batch_raw_output():
+    vcs = LocalVcs('', code_dir='hello', use_sudo=False)
+
+    batch = vcs.batch()
+    raw = batch.add("printf 'a\\000b\\000'", raw=True)
+    text = batch.add("printf 'a\\000b\\000'")
+    batch.execute()
+
+    assert raw.result() == 'a\x00b\x00'
+    assert text.result() == 'ab'
+
+
+def test_fix_output_text_matches_ftfy():
+    import ftfy
+
+    samples = [
+        'abc123 master T <t@t> plain ascii\n',
+        'tab\tseparated\n',
+        'html &amp; entities',
+        'windows\r\nline breaks',
+        'terminal \x1b[31mcolors\x1b[0m',
+        u'\xc3\xa4 mojibake',
+        u'proper \xe4 unicode',
+    ]
+
+    for sample in samples:
+        assert BaseVcs.fix_output_text(sample) == ftfy.fix_text(sample)
+
+
+def test_fetch_freshness():
+    vcs = BaseVcs('', code_dir='/srv/fresh', use_sudo=False, fetch_ttl=60)
+    vcs.invalidate_fetch()
+
+    assert not vcs.is_fetch_fresh()
+    assert vcs.get_resolved_revision('master') is None
+
+    vcs.mark_fetched()
+    vcs.set_resolved_revision('master', ('origin/master', None))
+
+    assert vcs.is_fetch_fresh()
+    assert vcs.get_resolved_revision('master') == ('origin/master', None)
+
+    # Freshness is shared by all instances using the same code_dir
+    other = BaseVcs('', code_dir='/srv/fresh', use_sudo=False, fetch_ttl=60)
+    assert other.is_fetch_fresh()
+    assert other.get_resolved_revision('master') == ('origin/master', None)
+
+    # ... unless reuse is disabled
+    disabled = BaseVcs('', code_dir='/srv/fresh', use_sudo=False)
+    assert not disabled.is_fetch_fresh()
+    assert disabled.get_resolved_revision('master') is None
+
+    vcs.forget_resolved_revisions()
+    assert vcs.get_resolved_revision('master') is None
+
+    vcs.invalidate_fetch()
+    assert not other.is_fetch_fresh()
+
+
+def test_hg_update_forgets_changesets(tmpdir):
+    from hammer.vcs.hg import Mercurial
+
+    class LocalMercurial(Mercurial):
+        def remote_cmd(self, command, **kwargs):
+            return as_str(subprocess.check_output(['sh', '-c', command], cwd=self.cmd_cwd_stack[-1])).rstrip('\n')
+
+    code_dir = str(tmpdir)
+
+    def hg(*args):
+        subprocess.check_output(('hg', '--config', 'ui.username=T <t@t>') + args, cwd=code_dir)
+
+    hg('init')
+
+    for name in ('1.txt', '2.txt', '3.txt'):
+        tmpdir.join(name).write(name)
+        hg('commit', '-A', '-m', name)
+
+    vcs = LocalMercurial('', code_dir=code_dir, use_sudo=False, fetch_ttl=60)
+    vcs.mark_fetched()
+
+    vcs.update('0')
+    assert vcs.get_changeset('.::2').paths == ['2.txt', '3.txt']
+
+    # The pull is skipped (the repository is fresh), the changeset must still be recomputed for the new parent
+    vcs.update('1')
+    assert vcs.is_fetch_fresh()
+    assert vcs.get_changeset('.::2').paths == ['3.txt']
+
+
+def test_mirror_updated_once_per_fetch_ttl(tmpdir):
+    from hammer.vcs.base import _mirror_registry
+
+    updates = os.path.join(str(tmpdir), 'updates')
+
+    class MirrorVcs(LocalVcs):
+        MIRROR_SUFFIX = '.git'
+
+        def repo_url(self):
+            return 'git@example.com:project.git'
+
+        def _mirror_update_cmd(self, mirror_path):
+            return 'echo x >> %s' % updates
+
+    def update_count():
+        with open(updates) as handle:
+            return len(handle.read().splitlines())
+
+    slots = [MirrorVcs('', code_dir='/srv/slot%d' % i, use_sudo=False, mirror_dir='/srv/mirrors', fetch_ttl=60)
+             for i in range(3)]
+
+    # All code_dirs of the same repository share a mirror
+    assert len(set(vcs.mirror_path() for vcs in slots)) == 1
+    assert slots[0].mirror_path().startswith('/srv/mirrors/')
+    assert slots[0].mirror_path().endswith('.git')
+
+    for vcs in slots:
+        vcs.update_mirror()
+
+    assert update_count() == 1
+
+    slots[1].update_mirror(force=True)
+    assert update_count() == 2
+
+    # The mirror is fetched again once it is older than fetch_ttl
+    _mirror_registry[(slots[0].host, slots[0].mirror_path())] -= 61
+    slots[2].update_mirror()
+    assert update_count() == 3
+
+    # ... and every time without fetch_ttl
+    no_ttl = MirrorVcs('', code_dir='/srv/slot3', use_sudo=False, mirror_dir='/srv/mirrors')
+    no_ttl.update_mirror()
+    no_ttl.update_mirror()
+    assert update_count() == 5
+
+    assert BaseVcs('', code_dir='/srv/slot0', use_sudo=False).mirror_path() is None
+
+    # pull(force=True) fetches the mirror from origin as well
+    class MirrorGit(Git):
+        def repo_url(self):
+            return 'git@example.com:project.git'
+
+    git = MirrorGit('', code_dir='/srv/slot0', use_sudo=False, mirror_dir='/srv/mirrors', fetch_ttl=60)
+    _mirror_registry[(git.host, git.mirror_path())] = time.time()
+
+    batch = git.batch()
+    git._batch_fetch(batch, force=True)
+    assert 'fetch --prune --quiet origin' in batch.commands[0].command
+
+
+def test_filter_changes():
+    entries = ['A dogs.png', 'M 3.txt', 'A docs/index.rst', 'D old.txt', 'M docs/conf.py']
+
+    assert list(filter_changes(entries)) == entries
+    assert list(filter_changes(entries, r'(\.png|\.txt)$')) == ['A dogs.png', 'M 3.txt', 'D old.txt']
+
+    # Entries matching several patterns are returned once, in the original order
+    assert list(filter_changes(entries, [r'^M ', r'\.txt$'])) == ['M 3.txt', 'D old.txt', 'M docs/conf.py']
+
+    # Glob patterns match the file name
+    assert list(filter_changes(entries, ['glob:docs/*', r'^D '])) == ['A docs/index.rst', 'D old.txt', 'M docs/conf.py']
+
+    # Patterns that can't be combined into a single regex still work
+    assert list(filter_changes(entries, [r'(?P<x>\.png)$', r'(?P<x>\.rst)$'])) == ['A dogs.png', 'A docs/index.rst']
+
+    assert compile_filter([r'^M ', r'\.txt$']) is compile_filter([r'^M ', r'\.txt$'])
+
+
+def test_filter_changes_compiled_patterns():
+    entries = ['A dogs.png', 'M 3.txt', 'A docs/index.rst', 'D OLD.TXT']
+
+    assert list(filter_changes(entries, re.compile(r'\.txt$', re.IGNORECASE))) == ['M 3.txt', 'D OLD.TXT']
+    assert list(filter_changes(entries, [re.compile(r'\.png$'), 'glob:*.rst', r'^M '])) == [
+        'A dogs.png', 'M 3.txt', 'A docs/index.rst',
+    ]
+
+    changes = ChangeSet([FileChange('A', 'dogs.png'), FileChange('M', '3.txt')])
+    assert changes.filter(re.compile(r'^M ')) == [FileChange('M', '3.txt')]
+    assert list(iter_lines('A a\n\nM b\r\nD c')) == ['A a', 'M b', 'D c']
+
+
+def test_changeset_index():
+    changes = ChangeSet([
+        FileChange('M', 'requirements.txt'),
+        FileChange('A', 'app/migrations/0002_auto.py'),
+        FileChange('M', 'app/views.py'),
+        FileChange('D', 'static/js/old.JS'),
+        FileChange('R', 'app/templates/new.html', old_path='templates/old.html', similarity=97),
+    ])
+
+    assert len(changes) == 5
+    assert 'requirements.txt' in changes
+    assert 'templates/old.html' in changes
+    assert changes.get('templates/old.html').path == 'app/templates/new.html'
+
+    assert changes.any(directory='app/migrations', extensions='.py')
+    assert not changes.any(directory='app/migrations', actions=['D'])
+    assert [x.path for x in changes.in_directory('app/')] == [
+        'app/migrations/0002_auto.py', 'app/views.py', 'app/templates/new.html',
+    ]
+    assert [x.path for x in changes.with_extension('js', '.html')] == ['static/js/old.JS', 'app/templates/new.html']
+    assert [x.path for x in changes.with_action('D', 'R')] == ['static/js/old.JS', 'app/templates/new.html']
+    assert changes.in_directory('templates') == changes.with_action('R')
+
+    assert changes.entries[-1] == 'R097 templates/old.html app/templates/new.html'
+    assert [x.path for x in changes.filter([r'^M ', 'glob:*.py'])] == [
+        'requirements.txt', 'app/migrations/0002_auto.py', 'app/views.py',
+    ]
+
+
+def test_git_parse_name_status():
+    output = 'M\x00foo bar.txt\x00R097\x00old\tname.py\x00new name.py\x00C075\x00a.txt\x00b.txt\x00D\x00\xe4.txt\x00'
+
+    assert list(Git.parse_name_status(output)) == [
+        FileChange('M', 'foo bar.txt'),
+        FileChange('R', 'new name.py', old_path='old\tname.py', similarity=97),
+        FileChange('C', 'b.txt', old_path='a.txt', similarity=75),
+        FileChange('D', u'\xe4.txt'),
+    ]
+    assert list(Git.parse_name_status('')) == []
+
+    for truncated in ['R100\x00old\x00', 'M\x00a.txt\x00D', 'M\x00a.txt\x00\x00b.txt\x00']:
+        with pytest.raises(ValueError):
+            list(Git.parse_name_status(truncated))
+
+
+def test_git_changed_files_without_renames(tmpdir):
+    code_dir = str(tmpdir)
+
+    def git(*args):
+        subprocess.check_output(('git', '-c', 'user.name=T', '-c', 'user.email=t@t') + args, cwd=code_dir)
+
+    git('init', '-q')
+    tmpdir.join('old.txt').write('\n'.join(str(x) for x in range(100)))
+    git('add', '.')
+    git('commit', '-q', '-m', 'initial')
+    git('mv', 'old.txt', 'new.txt')
+    git('commit', '-q', '-m', 'rename')
+
+    vcs = LocalGit('', code_dir=code_dir, use_sudo=False)
+
+    # changed_files keeps reporting renames as deleted and added files
+    assert vcs.changed_files('HEAD~1..HEAD') == ['A new.txt', 'D old.txt']
+    assert vcs.changed_files('HEAD~1..HEAD', r'^D ') == ['D old.txt']
+
+    # ... renames are only detected by get_changeset
+    assert vcs.get_changeset('HEAD~1..HEAD').entries == ['R100 old.txt new.txt']
+
+
+def test_git_pull_prunes_deleted_branches(tmpdir):
+    origin, code_dir = str(tmpdir.join('origin')), str(tmpdir.join('checkout'))
+
+    def git(cwd, *args):
+        subprocess.check_output(('git', '-c', 'user.name=T', '-c', 'user.email=t@t') + args, cwd=cwd)
+
+    git(str(tmpdir), 'init', '-q', origin)
+    git(origin, 'commit', '-q', '--allow-empty', '-m', 'initial')
+    git(origin, 'branch', 'feature')
+    git(str(tmpdir), 'clone', '-q', origin, code_dir)
+
+    vcs = LocalGit('', code_dir=code_dir, use_sudo=False)
+    vcs.pull()
+    assert vcs.has_revision('feature')
+
+    git(origin, 'branch', '-D', 'feature')
+    vcs.pull()
+    assert 'refs/remotes/origin/feature' not in vcs.get_refs_snapshot()[1]
+    assert not vcs._has_branch_in_snapshot('feature')
+
+
+def test_changeset_memoized_per_revset():
+    class ChangesVcs(BaseVcs):
+        diffs = 0
+
+        def _changed_file_records(self, revision_set):
+            ChangesVcs.diffs += 1
+
+            return [FileChange('M', '%s.txt' % revision_set)]
+
+    vcs = ChangesVcs('', code_dir='/srv/changes', use_sudo=False)
+    vcs.invalidate_fetch()
+
+    assert vcs.get_changeset('a..b') is vcs.get_changeset('a..b')
+    assert 'a..b.txt' in vcs.get_changeset('a..b')
+    assert ChangesVcs.diffs == 1
+
+    vcs.get_changeset('b..c')
+    assert ChangesVcs.diffs == 2
+
+    # Fetching forgets the index
+    vcs.mark_fetched()
+    vcs.get_changeset('a..b')
+    assert ChangesVcs.diffs == 3
+
+
+def test_parse_git_remotes():
+    config = '\n'.join([
+        '[core]',
+        '\tbare = false',
+        '[remote "origin"]',
+        '\turl = git@github.com:thorgate/tg-hammer.git',
+        '\tfetch = +refs/heads/*:refs/remotes/origin/*',
+        '# [remote "commented"]',
+        '[remote "upstream"]',
+        '\tURL = "ssh://example.com/with space.git" ; comment',
+        '[branch "master"]',
+        '\tremote = origin',
+    ])
+
+    assert parse_git_remotes(config) == [
+        ('origin', 'git@github.com:thorgate/tg-hammer.git'),
+        ('upstream', 'ssh://example.com/with space.git'),
+    ]
+
+    # Includes can't be handled without git
+    assert parse_git_remotes('[include]\n\tpath = other.config\n') is None
+
+
+def test_parse_hg_paths():
+    config = '\n'.join([
+        '[ui]',
+        'username = Testing user <test@test.sdf>',
+        '[paths]',
+        'default = ssh://root@hammer.repo.host//repos/hg/test',
+        'local = ../other',
+    ])
+
+    assert parse_hg_paths(config, '/repos/project') == [
+        ('default', 'ssh://root@hammer.repo.host//repos/hg/test'),
+        ('local', '/repos/other'),
+    ]
+
+    assert parse_hg_paths('%include ../shared.rc\n', '/repos/project') is None
+
+
+def test_git_remotes_memoized_until_config_changes(tmpdir):
+    tmpdir.mkdir('.git')
+    config = tmpdir.join('.git', 'config')
+    config.write('[core]\n\tbare = false\n')
+
+    assert git_remotes(str(tmpdir)) == []
+
+    config.write('[core]\n\tbare = false\n[remote "origin"]\n\turl = /repos/git/test.git\n')
+
+    assert git_remotes(str(tmpdir.mkdir('subdir'))) == [('origin', '/repos/git/test.git')]
@@ -85,6 +85,23 @@ def test_vcs_clone(repo, get_context):
     assert obj.get_branch() == repo.default_branch
 
 
+def test_vcs_clone_with_options(repo, get_context):
+    context = get_context('staging.hammer')
+    code_dir = '/srv/%s_project_fast' % repo.vcs_type
+
+    obj = repo.get_vcs(code_dir=code_dir, context=context)
+    obj.sudo('rm -rf %s' % code_dir)
+
+    if repo.vcs_type == 'git':
+        obj.clone(depth=1, reference='/srv/git_project')
+
+    else:
+        obj.clone(share_from='/srv/hg_project')
+
+    assert obj.version() == repo.get_vcs(context=context).version()
+    obj.sudo('rm -rf %s' % code_dir)
+
+
 def test_vcs_deploy(repo, get_context):
     # make another commit
     repo.store_commit_hash('5.txt')
@@ -355,6 +372,22 @@ def test_stable_branch(repo, get_context):
         'M 3.txt',
     ]
 
+    # Test the changed files index
+    changes = obj.get_changeset(result['revset'])
+
+    assert sorted(changes.paths) == ['3.txt', 'dogs.png', 'world is kind']
+    assert [x.path for x in changes.with_extension('.png')] == ['dogs.png']
+    assert changes.get('3.txt').action == 'M'
+    assert obj.get_changeset(result['revset']) is changes
+
+    # Test changed files with glob patterns
+    files = list(obj.iter_changed_files(result['revset'], ['glob:*.png', 'glob:*.txt', r'^M ']))
+
+    assert sorted(files) == [
+        'A dogs.png',
+        'M 3.txt',
+    ]
+
     # Apply backwards action
     obj.update(target_version)
     assert list(obj.version()) == [
@@ -446,6 +479,50 @@ def test_vcs_deploy_with_wrong_branchname_or_revision(repo, get_context):
             obj.update(revision='4c92374f88ad10bf4b658355d2784540e4192927')
 
 
+def test_has_revision_uses_refs_snapshot(repo, get_context):
+    if repo.vcs_type == 'git':
+        context = get_context('staging.hammer')
+        obj = repo.get_vcs(context=context)
+        obj.pull()
+
+        origin_url, refs = obj.get_refs_snapshot()
+        assert origin_url == repo.expected_remote
+        assert 'refs/remotes/origin/featureXXX/YYY/ZZZ' in refs
+
+        assert obj.has_revision('featureXXX/YYY/ZZZ')
+        assert not obj.has_revision('feature-branch/does-not-exist-in-remote-server')
+
+        # Same results when asking the remote repository directly
+        assert int(obj.has_revision('featureXXX/YYY/ZZZ', ls_remote=True))
+        assert not obj.has_revision('feature-branch/does-not-exist-in-remote-server', ls_remote=True)
+
+
+def test_single_branch_clone_can_deploy_other_branches(repo, get_context):
+    if repo.vcs_type == 'git':
+        context = get_context('staging.hammer')
+        code_dir = '/srv/git_project_single'
+
+        obj = repo.get_vcs(code_dir=code_dir, context=context)
+        obj.sudo('rm -rf %s' % code_dir)
+        obj.clone(single_branch=True)
+
+        assert obj.is_single_branch()
+        assert 'refs/remotes/origin/featureXXX/YYY/ZZZ' not in obj.get_refs_snapshot()[1]
+
+        # Branches which are not fetched by the clone are looked up from the remote repository
+        assert int(obj.has_revision('featureXXX/YYY/ZZZ'))
+        assert not obj.has_revision('feature-branch/does-not-exist-in-remote-server')
+
+        obj.update('featureXXX/YYY/ZZZ')
+        assert obj.version()[0] == repo.commit_hash['7.txt']
+
+        # ... and tracked from then on
+        obj.pull(force=True)
+        assert 'refs/remotes/origin/featureXXX/YYY/ZZZ' in obj.get_refs_snapshot()[1]
+
+        obj.sudo('rm -rf %s' % code_dir)
+
+
 def test_vcs_deployment_list(repo, get_context):
     branch_name = 'top_secret'
 
@@ -608,6 +685,26 @@ def test_multiple_commits_question(repo, monkeypatch, get_context):
         assert branch == 'very_very_very_stable', repr((branch, 'very_very_very_stable'))
 
 
+def test_resolve_branches(repo, get_context):
+    if repo.vcs_type == 'git':
+        context = get_context('staging.hammer')
+        obj = repo.get_vcs(context=context)
+
+        obj.resolve_branches([repo.commit_hash['1:merge->stable'], repo.commit_hash['12.txt']])
+
+        assert obj._branch_cache == {repo.commit_hash['1:merge->stable']: 'stable'}
+        assert obj._branch_candidates == {repo.commit_hash['12.txt']: ['master', 'stable']}
+
+        # Resolved commits should not require any more lookups
+        assert obj.get_branch(repo.commit_hash['1:merge->stable']) == 'stable'
+        assert obj.get_branch(repo.commit_hash['12.txt'], ambiguous=True) == 'master|stable'
+
+        # git_what_branch should find the same branches with a single remote command
+        obj._branch_cache = {}
+        assert obj.git_what_branch(repo.commit_hash['1:merge->stable'], remote=True) == (['stable'], repo.commit_hash['1:merge->stable'])
+        assert obj.git_what_branch(repo.commit_hash['12.txt'], remote=True) == (['master', 'stable'], repo.commit_hash['12.txt'])
+
+
 def test_commit_messages_with_formatting_chars(repo, get_context):
     repo.store_commit_hash('HELLO %', branch=[repo.default_branch])
     repo.store_commit_hash('Commit {} message', branch=[repo.default_branch])